@@ -7,12 +7,36 @@ __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
 class Annotator:
-    """A base class for annotators."""
+    """
+    A base class for annotators.  max_tokens is the length of the longest span
+    the annotator can annotate, or None if there is no limit.  The parser never
+    asks an annotator to annotate a longer span.
+    """
+    max_tokens = None
+
     def annotate(self, tokens):
         """Returns a list of pairs, each a category and a semantic representation."""
         return []
 
+    def annotate_sentence(self, tokens):
+        """
+        Returns a list of tuples (i, j, category, semantics), one for each
+        annotation of each span tokens[i:j] of the whole sentence.  This is what
+        the parser calls.  The default implementation calls annotate() on every
+        span no longer than max_tokens; annotators which can find all their
+        annotations more cheaply in a single pass may override it.
+        """
+        annotations = []
+        max_tokens = len(tokens) if self.max_tokens is None else self.max_tokens
+        for j in range(1, len(tokens) + 1):
+            for i in range(j - 1, max(j - max_tokens, 0) - 1, -1):
+                for category, semantics in self.annotate(tokens[i:j]):
+                    annotations.append((i, j, category, semantics))
+        return annotations
+
 class TokenAnnotator(Annotator):
+    max_tokens = 1
+
     def annotate(self, tokens):
         if len(tokens) == 1:
             return [('$Token', tokens[0])]
@@ -20,6 +44,8 @@ class TokenAnnotator(Annotator):
             return []
 
 class NumberAnnotator(Annotator):
+    max_tokens = 1
+
     def annotate(self, tokens):
         if len(tokens) == 1:
             try:
@@ -34,7 +60,6 @@ class NumberAnnotator(Annotator):
 if __name__ == '__main__':
     annotators = [TokenAnnotator(), NumberAnnotator()]
     tokens = 'four score and 30 years ago'.split()
-    for j in range(1, len(tokens) + 1):
-        for i in range(j - 1, -1, -1):
-            annotations = [a for anno in annotators for a in anno.annotate(tokens[i:j])]
-            print('(%d, %d): %s => %s' % (i, j, ' '.join(tokens[i:j]), annotations))
+    for annotator in annotators:
+        for i, j, category, semantics in annotator.annotate_sentence(tokens):
+            print('(%d, %d): %s => %s' % (i, j, ' '.join(tokens[i:j]), (category, semantics)))
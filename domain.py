@@ -63,6 +63,14 @@ class Domain:
         """
         return defaultdict(float)
 
+    def coarse_features(self, parse):
+        """
+        Like features(), but must not depend on the denotation of the parse, so
+        that parses can be ranked before they are executed.  (See
+        scoring.Model.score_parses().)  By default, the same as features().
+        """
+        return self.features(parse)
+
     def weights(self):
         return defaultdict(float)
 
@@ -76,11 +84,13 @@ class Domain:
         """
         return None
 
-    def model(self):
+    def model(self, rerank_k=None):
         return Model(grammar=self.grammar(),
                      feature_fn=self.features,
                      weights=self.weights(),
-                     executor=self.execute)
+                     executor=self.execute,
+                     coarse_feature_fn=self.coarse_features,
+                     rerank_k=rerank_k)
 
     def metrics(self):
         """Returns a list of Metrics which are appropriate for the domain."""
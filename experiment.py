@@ -12,8 +12,9 @@ import random
 from metrics import SemanticsAccuracyMetric, NumParsesMetric, standard_metrics
 from example import Example
 from learning import latent_sgd
-from parsing import is_cat, parse_to_pretty_string, print_grammar
-from scoring import Model, rule_features
+from parsing import (IncrementalParser, is_cat, parse_to_pretty_string, print_grammar,
+                     uses_beam)
+from scoring import Model, rule_features, rule_score
 
 # TODO: comment
 def print_sample_outcomes(model=None,
@@ -106,14 +107,27 @@ def evaluate_model(model=None,
                    examples=[],
                    examples_label=None,
                    metrics=standard_metrics(),
-                   print_examples=True):
+                   print_examples=True,
+                   k=None,
+                   processes=1):
+    """
+    Evaluates the model on the given examples, reporting the average of each
+    metric.  If k is given, the metrics see only the k best parses of each
+    example (see Model.parse_input()).  If processes is greater than 1 (or
+    None, meaning one per core), the examples are parsed in parallel (see
+    Model.parse_batch()).
+    """
     print('=' * 80)
     print('Evaluating on %d %sexamples\n' % (
         len(examples), examples_label + ' ' if examples_label else ''))
     print('-' * 80)
     metric_values = defaultdict(int)
-    for example in examples:
-        parses = model.parse_input(example.input)
+    if processes == 1:
+        all_parses = (model.parse_input(example.input, k=k) for example in examples)
+    else:
+        all_parses = model.parse_batch([example.input for example in examples],
+                                       k=k, processes=processes)
+    for example, parses in zip(examples, all_parses):
         for metric in metrics:
             metric_value = metric.evaluate(example, parses)
             metric_values[metric.name()] += metric_value
@@ -258,7 +272,7 @@ def learn_lexical_semantics(domain, seed=None):
                       start_symbol=original_grammar.start_symbol)
     model = Model(grammar=grammar,
                   feature_fn=domain.features,
-                  weights=domain.weights,
+                  weights=domain.weights(),
                   executor=domain.execute)
     train_test(model=model,
                train_examples=domain.train_examples(),
@@ -276,6 +290,12 @@ def interact(domain, example_input=None, T=10):
                        training_metric=domain.training_metric(),
                        T=T)
 
+    # Consecutive queries usually share a prefix, which need not be reparsed.
+    if uses_beam(model.grammar):
+        parser = IncrementalParser(model.grammar,
+                                   rule_score_fn=lambda rule: rule_score(rule, model.weights))
+    else:
+        parser = IncrementalParser(model.grammar)
     print('\nHello! Enter a query%s:' % (', such as "%s"' % example_input if example_input else ''))
     while True:
         try:
@@ -284,7 +304,7 @@ def interact(domain, example_input=None, T=10):
             print('\nBye!')
             return
         example = Example(input=query)
-        parses = model.parse_input(query)
+        parses = model.score_parses(parser.parse(query))
         if parses:
             print_parses(example, parses)
         else:
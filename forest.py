@@ -0,0 +1,429 @@
+"""
+Packed parse forests.
+
+The chart parser in parsing.py builds a separate Parse object for every
+derivation of every span, so the number of objects it creates grows with the
+number of derivations, which can be exponential in the length of the input.  A
+packed forest instead has one ForestNode per (span, category), and each node
+holds back-pointers to the alternative ways of deriving it.  (Where the grammar
+has unary cycles, a few more nodes are needed; see apply_cyclic_unary_rules().)
+No semantics are computed while the forest is built.  Individual derivations
+are unpacked into ordinary Parse objects only on request, typically via
+kbest_parses(), and their semantics are then computed on demand, like those of
+any other Parse.  Quantities summed over all derivations, such as the expected
+number of uses of each rule, are computed by inside-outside over the forest
+itself.
+
+For example:
+
+    forest = parse_forest(grammar, 'two times two plus three')
+    num_derivations(forest.root)                # 2
+    kbest_parses(forest, 1, rule_score_fn)      # [the best-scoring Parse]
+    expected_rule_counts(forest, rule_score_fn) # (log Z, map from rule to count)
+"""
+
+from __future__ import print_function
+
+import heapq
+import math
+
+from parsing import (Parse, Rule, compile_grammar, find_annotations, find_lexical_matches,
+                     symbol_ids, symbols)
+
+
+# Forest =======================================================================
+
+class ForestNode:
+    """
+    Represents all derivations of one category over one span.  Each element of
+    derivations is a pair (rule, children), where children is a tuple of
+    ForestNodes (for compositional rules) or a tuple of tokens (for lexical
+    rules and annotations).
+    """
+    def __init__(self, category_id, start, end):
+        self.category_id = category_id
+        self.category = symbols[category_id]
+        self.start = start
+        self.end = end
+        self.derivations = []
+
+    def __str__(self):
+        return 'ForestNode(%s, %d, %d, %d derivations)' % (
+            self.category, self.start, self.end, len(self.derivations))
+
+class Forest:
+    """
+    The packed forest for one input.  The chart has the same triangular layout
+    as the parse chart in parsing.py, but each cell is a map from category id
+    to ForestNode.  root is the node for the start symbol over the whole input,
+    or None if there is no such node.  (If the grammar has no start symbol, root
+    is the sole node spanning the whole input, if there is exactly one.)
+    """
+    def __init__(self, tokens, chart, root):
+        self.tokens = tokens
+        self.chart = chart
+        self.root = root
+
+def is_node_derivation(children):
+    return len(children) > 0 and isinstance(children[0], ForestNode)
+
+def parse_forest(grammar, input):
+    """Returns the packed Forest for the given input under the given grammar."""
+    compiled = compile_grammar(grammar)
+    tokens = input.split()
+    token_ids = tuple(symbol_ids.get(token, -1) for token in tokens)
+    lexical_matches = find_lexical_matches(compiled, token_ids)
+    annotations = find_annotations(grammar, tokens)
+    chart = [[{} for i in range(j)] for j in range(len(tokens) + 1)]
+    for j in range(1, len(tokens) + 1):
+        for i in range(j - 1, -1, -1):
+            cell = chart[j][i]
+            fill_forest_cell(compiled, chart, cell, tokens, annotations[j].get(i, ()),
+                             lexical_matches[j].get(i, ()), i, j)
+    root = None
+    if tokens:
+        top_cell = chart[len(tokens)][0]
+        if compiled.start_id is not None:
+            root = top_cell.get(compiled.start_id)
+        elif len(top_cell) == 1:
+            root = list(top_cell.values())[0]
+    return Forest(tokens, chart, root)
+
+def fill_forest_cell(compiled, chart, cell, tokens, annotations, lexical_rules, i, j):
+    def node_for(category_id):
+        node = cell.get(category_id)
+        if node is None:
+            node = ForestNode(category_id, i, j)
+            cell[category_id] = node
+        return node
+    span_tokens = tuple(tokens[i:j])
+    for category, semantics in annotations:
+        rule = Rule(category, span_tokens, semantics)
+        node_for(rule.lhs_id).derivations.append((rule, span_tokens))
+    for rule in lexical_rules:
+        node_for(rule.lhs_id).derivations.append((rule, span_tokens))
+    for k in range(i + 1, j):
+        right_cell = chart[j][k]
+        if not right_cell:
+            continue
+        for left_id, left in list(chart[k][i].items()):
+            rules_by_right = compiled.binary.get(left_id)
+            if not rules_by_right:
+                continue
+            for right_id, right in list(right_cell.items()):
+                for rule in rules_by_right.get(right_id, ()):
+                    node_for(rule.lhs_id).derivations.append((rule, (left, right)))
+    apply_forest_unary_rules(compiled, cell, node_for)
+
+def apply_forest_unary_rules(compiled, cell, node_for):
+    """
+    Adds the unary derivations of the nodes of a forest cell, so that the
+    forest packs the same parses as the chart parser builds (see
+    parsing.apply_unary_rules()): every chain of unary rules is applied, except
+    that a chain stops short of any rule which would produce a category already
+    produced along it.  The categories are handled in a topological order of
+    the components of unary cycles (see parsing.find_unary_cycles()), so all
+    the derivations which enter a component are known before the derivations
+    within it are added (see apply_cyclic_unary_rules()).
+    """
+    components = compiled.unary_components
+    expanded = set()
+    for category_id in compiled.unary_order:
+        component = components.get(category_id)
+        if component is not None and component not in expanded:
+            expanded.add(component)
+            apply_cyclic_unary_rules(compiled, cell, node_for, component)
+        node = cell.get(category_id)
+        if node is None:
+            continue
+        for rule in compiled.unary.get(category_id, ()):
+            if component is None or components.get(rule.lhs_id) != component:
+                node_for(rule.lhs_id).derivations.append((rule, (node,)))
+
+def apply_cyclic_unary_rules(compiled, cell, node_for, component):
+    """
+    Adds the unary derivations within one component of unary cycles to the
+    nodes of a forest cell.  A node derived from another node of the same
+    component cannot simply point back at it, since the forest must remain
+    acyclic, so the chains within the component are built from further nodes,
+    one for each category and set of categories of the component produced
+    along the chains which derive it.  Each chain starts at a copy of a cell
+    node holding only the derivations which enter the component.
+    """
+    components = compiled.unary_components
+    chain_nodes = {}
+    agenda = []
+    for category_id in compiled.unary_cycles[component]:
+        node = cell.get(category_id)
+        if node is not None:
+            entry = ForestNode(category_id, node.start, node.end)
+            entry.derivations = list(node.derivations)
+            key = (category_id, frozenset([category_id]))
+            chain_nodes[key] = entry
+            agenda.append(key)
+    # The agenda grows as we iterate over it.
+    for category_id, produced in agenda:
+        source = chain_nodes[(category_id, produced)]
+        for rule in compiled.unary.get(category_id, ()):
+            if components.get(rule.lhs_id) != component or rule.lhs_id in produced:
+                continue
+            key = (rule.lhs_id, produced | frozenset([rule.lhs_id]))
+            target = chain_nodes.get(key)
+            if target is None:
+                target = ForestNode(rule.lhs_id, source.start, source.end)
+                chain_nodes[key] = target
+                agenda.append(key)
+            target.derivations.append((rule, (source,)))
+            node_for(rule.lhs_id).derivations.append((rule, (source,)))
+
+def num_derivations(node, memo=None):
+    """Returns the number of distinct derivations packed into the given node."""
+    if node is None:
+        return 0
+    if memo is None:
+        memo = {}
+    if id(node) not in memo:
+        total = 0
+        for rule, children in node.derivations:
+            count = 1
+            if is_node_derivation(children):
+                for child in children:
+                    count *= num_derivations(child, memo)
+            total += count
+        memo[id(node)] = total
+    return memo[id(node)]
+
+
+# k-best extraction ============================================================
+
+class KBestState:
+    """
+    The lazy k-best state of one node: the derivations extracted so far, in
+    order of decreasing score, and a heap of candidates for the next one.
+    """
+    def __init__(self):
+        self.derivations = []  # list of (score, derivation index, child ranks)
+        self.candidates = None
+        self.seen = set()
+
+def kbest_parses(forest, k, rule_score_fn=None):
+    """
+    Returns (at most) the k highest-scoring parses packed into the forest, in
+    order of decreasing score, where the score of a parse is the sum of
+    rule_score_fn(rule) over all rules used in it.  This is the lazy k-best
+    algorithm of Huang & Chiang (2005): the work done is roughly proportional
+    to k and the size of the forest, not to the number of derivations.  If
+    rule_score_fn is None, all rules score zero, and the k parses returned are
+    an arbitrary k of the parses in the forest.
+    """
+    if forest.root is None or k <= 0:
+        return []
+    rule_score_fn = rule_score_fn or (lambda rule: 0.0)
+    states = {}
+    parses = []
+    for rank in range(k):
+        entry = kth_best(forest.root, rank, rule_score_fn, states)
+        if entry is None:
+            break
+        parses.append(unpack(forest.root, rank, states))
+    return parses
+
+def kth_best(node, rank, rule_score_fn, states):
+    """
+    Returns the (score, derivation index, child ranks) entry for the rank-th
+    best derivation of node (counting from zero), or None if there are not
+    that many derivations.
+    """
+    state = states.get(id(node))
+    if state is None:
+        state = KBestState()
+        states[id(node)] = state
+    if state.candidates is None:
+        state.candidates = []
+        for index in range(len(node.derivations)):
+            push_candidate(node, state, index, (0,) * num_children(node, index),
+                           rule_score_fn, states)
+    while len(state.derivations) <= rank and state.candidates:
+        neg_score, _, index, ranks = heapq.heappop(state.candidates)
+        state.derivations.append((-neg_score, index, ranks))
+        # Push the successors of the entry we just popped: for each child,
+        # the same derivation using that child's next-best subderivation.
+        for position in range(len(ranks)):
+            successor = ranks[:position] + (ranks[position] + 1,) + ranks[position + 1:]
+            push_candidate(node, state, index, successor, rule_score_fn, states)
+    if rank < len(state.derivations):
+        return state.derivations[rank]
+    return None
+
+def num_children(node, index):
+    rule, children = node.derivations[index]
+    return len(children) if is_node_derivation(children) else 0
+
+def push_candidate(node, state, index, ranks, rule_score_fn, states):
+    if (index, ranks) in state.seen:
+        return
+    rule, children = node.derivations[index]
+    score = rule_score_fn(rule)
+    for child, child_rank in zip(children[:len(ranks)], ranks):
+        entry = kth_best(child, child_rank, rule_score_fn, states)
+        if entry is None:
+            return
+        score += entry[0]
+    state.seen.add((index, ranks))
+    # The counter breaks ties in favor of earlier candidates, so that the
+    # result is deterministic.
+    heapq.heappush(state.candidates, (-score, len(state.seen), index, ranks))
+
+def unpack(node, rank, states):
+    """Builds the Parse for the rank-th best derivation of node."""
+    score, index, ranks = states[id(node)].derivations[rank]
+    rule, children = node.derivations[index]
+    if ranks:
+        children = [unpack(child, child_rank, states)
+                    for child, child_rank in zip(children, ranks)]
+    return Parse(rule, list(children))
+
+
+# Inside-outside ===============================================================
+
+def topological_nodes(forest):
+    """
+    Returns the nodes of the forest from which its root is derived, including
+    the root, each after all of the nodes it is derived from.
+    """
+    if forest.root is None:
+        return []
+    nodes = []
+    visited = set()
+    # A node is pushed a second time, marked as finished, beneath its children.
+    agenda = [(forest.root, False)]
+    while agenda:
+        node, finished = agenda.pop()
+        if finished:
+            nodes.append(node)
+            continue
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        agenda.append((node, True))
+        for rule, children in node.derivations:
+            if is_node_derivation(children):
+                for child in children:
+                    if id(child) not in visited:
+                        agenda.append((child, False))
+    return nodes
+
+def log_add(a, b):
+    """Returns log(exp(a) + exp(b)), without overflow."""
+    if a < b:
+        a, b = b, a
+    if b == float('-inf'):
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+def inside_scores(nodes, rule_score_fn):
+    """
+    Returns a map from the id of each of the given nodes, which must be in the
+    order given by topological_nodes(), to the log of the sum over its
+    derivations of the exp of the derivation's score, where the score of a
+    derivation is the sum of rule_score_fn(rule) over the rules it uses.
+    """
+    inside = {}
+    for node in nodes:
+        total = float('-inf')
+        for rule, children in node.derivations:
+            score = rule_score_fn(rule)
+            if is_node_derivation(children):
+                for child in children:
+                    score += inside[id(child)]
+            total = log_add(total, score)
+        inside[id(node)] = total
+    return inside
+
+def expected_rule_counts(forest, rule_score_fn, nodes=None):
+    """
+    Returns a pair: the log of the total exp score of the derivations packed
+    into the forest, and a map from each rule to its expected number of uses
+    when a derivation is drawn in proportion to its exp score.  This is the
+    inside-outside algorithm, which takes time linear in the size of the
+    forest, however many derivations it packs.  nodes may give the result of
+    topological_nodes(forest), if it is already known.  Returns (None, {}) if
+    there are no derivations.
+    """
+    if nodes is None:
+        nodes = topological_nodes(forest)
+    inside = inside_scores(nodes, rule_score_fn)
+    log_z = inside.get(id(forest.root), float('-inf'))
+    if log_z == float('-inf'):
+        return None, {}
+    outside = dict((id(node), float('-inf')) for node in nodes)
+    outside[id(forest.root)] = 0.0
+    counts = {}
+    for node in reversed(nodes):
+        node_outside = outside[id(node)]
+        if node_outside == float('-inf'):
+            continue
+        for rule, children in node.derivations:
+            if not is_node_derivation(children):
+                children = ()
+            score = rule_score_fn(rule)
+            for child in children:
+                score += inside[id(child)]
+            if score == float('-inf'):
+                continue
+            counts[rule] = counts.get(rule, 0.0) + math.exp(node_outside + score - log_z)
+            for child in children:
+                outside[id(child)] = log_add(outside[id(child)],
+                                             node_outside + score - inside[id(child)])
+    return log_z, counts
+
+
+# demo =========================================================================
+
+def demo():
+    """
+    Checks the forest against the chart parser, which enumerates every
+    derivation: the forest must pack the same number of derivations, and its
+    inside-outside log normalizer and expected rule counts must equal those
+    computed from the enumerated derivations.  The grammar has a unary cycle.
+    """
+    from parsing import Grammar
+    from scoring import rule_counts
+    rules = [
+        Rule('$A', 'a'),
+        Rule('$B', 'a'),
+        Rule('$A', '$B'),
+        Rule('$B', '$A'),
+        Rule('$A', '$A $B'),
+        Rule('$ROOT', '$A'),
+    ]
+    grammar = Grammar(rules=rules)
+    rule_scores = dict((rule, 0.1 * k - 0.2) for k, rule in enumerate(rules))
+    for input in ['a', 'a a', 'a a a', 'a a a a']:
+        parses = grammar.parse_input(input)
+        log_z = float('-inf')
+        parse_counts = []
+        for parse in parses:
+            counts = rule_counts(parse)
+            score = sum([rule_scores[rule] * count for rule, count in counts.items()])
+            parse_counts.append((score, counts))
+            log_z = log_add(log_z, score)
+        expected = {}
+        for score, counts in parse_counts:
+            for rule, count in counts.items():
+                expected[rule] = expected.get(rule, 0.0) + math.exp(score - log_z) * count
+        forest = parse_forest(grammar, input)
+        forest_log_z, forest_expected = expected_rule_counts(forest, rule_scores.get)
+        assert num_derivations(forest.root) == len(parses), input
+        assert len(kbest_parses(forest, len(parses) + 1)) == len(parses), input
+        assert abs(forest_log_z - log_z) < 1e-9, (input, forest_log_z, log_z)
+        for rule in rules:
+            assert abs(forest_expected.get(rule, 0.0) - expected.get(rule, 0.0)) < 1e-9, \
+                (input, str(rule))
+        print()
+        print('%-16s %s' % ('input', input))
+        print('%-16s %d' % ('derivations', len(parses)))
+        print('%-16s %.6f' % ('log Z', forest_log_z))
+
+if __name__ == '__main__':
+    demo()
@@ -452,7 +452,8 @@ class GeoQueryDomain(Domain):
             features['empty_denotation'] += 1.0
         return features
 
-    def features(self, parse):
+    def coarse_features(self, parse):
+        # The features which do not need a denotation.
         features = defaultdict(float)
         # TODO: turning off rule features seems to screw up learning
         # figure out what's going on here
@@ -460,6 +461,10 @@ class GeoQueryDomain(Domain):
         # Actually it doesn't seem to mess up final result.
         # But the train accuracy reported during SGD is misleading?
         features.update(rule_features(parse))
+        return features
+
+    def features(self, parse):
+        features = self.coarse_features(parse)
         features.update(self.empty_denotation_feature(parse))
         # EXERCISE: Experiment with additional features.
         return features
@@ -488,6 +493,8 @@ class GeoQueryDomain(Domain):
 class GeobaseAnnotator(Annotator):
     def __init__(self, geobase):
         self.geobase = geobase
+        names = [name for name, places in list(geobase.binaries_rev['name'].items()) if places]
+        self.max_tokens = max([len(name.split()) for name in names] or [0])
 
     def annotate(self, tokens):
         phrase = ' '.join(tokens)
@@ -27,8 +27,12 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+import binascii
+from bisect import bisect_left, bisect_right
 from collections import defaultdict, Iterable
-from types import FunctionType
+from numbers import Number
+
+import numpy as np
 
 class GraphKB:
     """
@@ -69,12 +73,33 @@ class GraphKB:
         ('has_mother', 'bart', 'marge')
         ('has_mother', 'lisa', 'marge')
         ('has_mother', 'maggie', 'marge'),
+
+    Internally, every element is interned to an integer id (see encode() and
+    decode()), each unary relation is stored as a sorted array of ids, and each
+    direction of each binary relation as an Adjacency in compressed sparse row
+    form, so that a join is a few array operations.  The arrays are built when
+    first needed after tuples are added.  For compatibility, nodes, unaries,
+    binaries_fwd and binaries_rev give read-only views of the relations in
+    terms of the elements themselves:
+
+        nodes                   the set of all elements
+        unaries[U]              the set of elements belonging to U
+        binaries_fwd[B][src]    the set of elements to which src has relation B
+        binaries_rev[B][dst]    the set of elements which have relation B to dst
+
+    Unlike the defaultdicts these views replace, looking up a missing key
+    yields an empty set without adding the key.
     """
     def __init__(self, tuples):
-        self.nodes = set()
-        self.unaries = defaultdict(set)
-        self.binaries_fwd = defaultdict(lambda : defaultdict(set))  # rel => src => {dst}
-        self.binaries_rev = defaultdict(lambda : defaultdict(set))  # rel => dst => {src}
+        self.node_ids = {}
+        self.node_values = []
+        self.unary_members = defaultdict(list)  # rel => [id], in order added
+        self.binary_pairs = defaultdict(list)   # rel => [(src id, dst id)], in order added
+        self.unary_index = None
+        self.binary_index = None
+        self.value_indexes = {}
+        self.str_rank_array = None
+        self.version = 0  # Incremented whenever a tuple is added.
         for tuple in tuples:
             if len(tuple) == 2:
                 self.add_unary(tuple)
@@ -82,16 +107,99 @@ class GraphKB:
                 self.add_binary(tuple)
             else:
                 assert False, 'Invalid tuple'
+        self.nodes = NodeView(self)
+        self.unaries = UnaryView(self)
+        self.binaries_fwd = BinaryView(self, rev=False)
+        self.binaries_rev = BinaryView(self, rev=True)
+
+    def intern_node(self, value):
+        node_id = self.node_ids.get(value)
+        if node_id is None:
+            node_id = len(self.node_values)
+            self.node_ids[value] = node_id
+            self.node_values.append(value)
+            self.str_rank_array = None
+        return node_id
 
     def add_unary(self, tuple):
-        self.nodes.add(tuple[1])
-        self.unaries[tuple[0]].add(tuple[1])
+        self.unary_members[tuple[0]].append(self.intern_node(tuple[1]))
+        self.unary_index = None
+        self.version += 1
 
     def add_binary(self, tuple):
-        self.nodes.add(tuple[1])
-        self.nodes.add(tuple[2])
-        self.binaries_fwd[tuple[0]][tuple[1]].add(tuple[2])
-        self.binaries_rev[tuple[0]][tuple[2]].add(tuple[1])
+        src, dst = self.intern_node(tuple[1]), self.intern_node(tuple[2])
+        self.binary_pairs[tuple[0]].append((src, dst))
+        self.binary_index = None
+        self.version += 1
+
+    def encode(self, values):
+        """
+        Returns a sorted array of the ids of those of the given values which
+        are elements of the graph.
+        """
+        ids = [self.node_ids[value] for value in values if value in self.node_ids]
+        return np.unique(np.array(ids, dtype=np.int64))
+
+    def decode(self, ids):
+        """Returns the list of elements with the given ids."""
+        values = self.node_values
+        return [values[node_id] for node_id in np.asarray(ids, dtype=np.int64).tolist()]
+
+    def unary(self, rel):
+        """Returns the sorted array of ids of the elements of unary relation rel."""
+        if self.unary_index is None:
+            self.unary_index = {}
+            for name, members in list(self.unary_members.items()):
+                self.unary_index[name] = np.unique(np.array(members, dtype=np.int64))
+        return self.unary_index.get(rel, EMPTY_IDS)
+
+    def adjacency(self, rel, rev=False):
+        """
+        Returns the Adjacency for binary relation rel, from sources to
+        destinations, or from destinations to sources if rev is true, or None
+        if there is no such relation.
+        """
+        if self.binary_index is None:
+            self.binary_index = {}
+            self.value_indexes = {}
+            for name, pairs in list(self.binary_pairs.items()):
+                pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+                self.binary_index[name] = (Adjacency(pairs[:, 0], pairs[:, 1]),
+                                           Adjacency(pairs[:, 1], pairs[:, 0]))
+        index = self.binary_index.get(rel)
+        if index is None:
+            return None
+        return index[1] if rev else index[0]
+
+    def str_ranks(self):
+        """
+        Returns the array giving, for each id, the position of its element
+        when all elements are sorted by their str(), as in sorted_tuple().
+        """
+        if self.str_rank_array is None:
+            order = sorted(range(len(self.node_values)), key=lambda k: str(self.node_values[k]))
+            self.str_rank_array = np.empty(len(order), dtype=np.int64)
+            self.str_rank_array[order] = np.arange(len(order))
+        return self.str_rank_array
+
+    def value_index(self, rel, rev=False):
+        """
+        Returns a pair (values, positions) for the Adjacency for binary
+        relation rel, where values is the sorted list of the elements of its
+        sources, and positions the array of their positions in its sources.
+        Returns None if the sources are not all numbers, since they cannot then
+        be kept in order.
+        """
+        key = (rel, rev)
+        if key not in self.value_indexes:
+            values = self.decode(self.adjacency(rel, rev).sources)
+            if all(isinstance(value, Number) for value in values):
+                order = sorted(range(len(values)), key=values.__getitem__)
+                self.value_indexes[key] = ([values[k] for k in order],
+                                           np.array(order, dtype=np.int64))
+            else:
+                self.value_indexes[key] = None
+        return self.value_indexes[key]
 
     def list(self):
         for rel in sorted(list(self.unaries.keys())):
@@ -105,6 +213,298 @@ class GraphKB:
     def executor(self):
         return GraphKBExecutor(self)
 
+EMPTY_IDS = np.zeros(0, dtype=np.int64)
+
+class Adjacency:
+    """
+    The edges of one direction of one binary relation, in compressed sparse
+    row form: sources is the sorted array of ids of the nodes having any edge,
+    and the targets of sources[k] are targets[offsets[k]:offsets[k + 1]], in
+    increasing order.
+    """
+    def __init__(self, srcs, dsts):
+        order = np.lexsort((dsts, srcs))
+        srcs, dsts = srcs[order], dsts[order]
+        if len(srcs):
+            # Drop duplicate edges.
+            keep = np.ones(len(srcs), dtype=bool)
+            keep[1:] = (srcs[1:] != srcs[:-1]) | (dsts[1:] != dsts[:-1])
+            srcs, dsts = srcs[keep], dsts[keep]
+        self.sources, starts = np.unique(srcs, return_index=True)
+        self.offsets = np.append(starts, len(srcs)).astype(np.int64)
+        self.targets = dsts
+        self.num_targets = len(np.unique(dsts))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def targets_of(self, src):
+        """Returns the sorted array of ids of the targets of the given id."""
+        k = np.searchsorted(self.sources, src)
+        if k < len(self.sources) and self.sources[k] == src:
+            return self.targets[self.offsets[k]:self.offsets[k + 1]]
+        return EMPTY_IDS
+
+    def edges(self, srcs):
+        """
+        Returns a pair of arrays holding the ids of the sources and targets of
+        every edge whose source is in the given sorted array of ids.
+        """
+        if not len(self.sources):
+            return EMPTY_IDS, EMPTY_IDS
+        positions = np.searchsorted(self.sources, srcs).clip(max=len(self.sources) - 1)
+        positions = positions[self.sources[positions] == srcs]
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # The index of every target of every source, in one array.
+        ends = np.cumsum(lengths)
+        indexes = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - starts, lengths)
+        return np.repeat(self.sources[positions], lengths), self.targets[indexes]
+
+    def join(self, srcs):
+        """
+        Returns the sorted array of ids of the targets of any of the given
+        sorted array of ids.
+        """
+        return np.unique(self.edges(srcs)[1])
+
+class NodeView(object):
+    """The set of elements of a GraphKB."""
+    def __init__(self, graph_kb):
+        self.graph_kb = graph_kb
+
+    def __contains__(self, value):
+        return value in self.graph_kb.node_ids
+
+    def __iter__(self):
+        return iter(self.graph_kb.node_values)
+
+    def __len__(self):
+        return len(self.graph_kb.node_values)
+
+class UnaryView(object):
+    """A read-only map from each unary relation of a GraphKB to its set of elements."""
+    def __init__(self, graph_kb):
+        self.graph_kb = graph_kb
+
+    def __contains__(self, rel):
+        return rel in self.graph_kb.unary_members
+
+    def __getitem__(self, rel):
+        return frozenset(self.graph_kb.decode(self.graph_kb.unary(rel)))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self.graph_kb.unary_members.keys())
+
+class BinaryView(object):
+    """
+    A read-only map from each binary relation of a GraphKB to an AdjacencyView
+    of one direction of it.
+    """
+    def __init__(self, graph_kb, rev):
+        self.graph_kb = graph_kb
+        self.rev = rev
+
+    def __contains__(self, rel):
+        return rel in self.graph_kb.binary_pairs
+
+    def __getitem__(self, rel):
+        return AdjacencyView(self.graph_kb, self.graph_kb.adjacency(rel, self.rev))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self.graph_kb.binary_pairs.keys())
+
+class AdjacencyView(object):
+    """A read-only map from each element to the set of its targets in an Adjacency."""
+    def __init__(self, graph_kb, adjacency):
+        self.graph_kb = graph_kb
+        self.adjacency = adjacency
+
+    def __contains__(self, value):
+        return len(self[value]) > 0
+
+    def __getitem__(self, value):
+        node_id = self.graph_kb.node_ids.get(value)
+        if self.adjacency is None or node_id is None:
+            return frozenset()
+        return frozenset(self.graph_kb.decode(self.adjacency.targets_of(node_id)))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        if self.adjacency is None:
+            return []
+        return self.graph_kb.decode(self.adjacency.sources)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+class NodeSet(object):
+    """
+    A set of values, most of them elements of a GraphKB, used for the
+    intermediate results of GraphKBExecutor.  The elements are held as a
+    bitset over their ids in a Python int, so that intersection, union and
+    complement are word-parallel operations on ints.  If complement is true,
+    the bitset gives the elements *not* in the set, so that complementing a
+    set never materializes it.  Any values which are not elements of the
+    GraphKB, such as the literal 7 in ('.or', 'state', 7), are held in
+    others; they are never in the complement of a set.
+
+    A NodeSet may instead be made from a sorted array of ids, such as the
+    result of a join, which is then only converted to a bitset if it takes
+    part in set algebra.  Neither form is ordered as the final denotation must
+    be; canonical() does that, once, for the result of a whole query.
+    """
+    def __init__(self, graph_kb, bits=0, complement=False, others=frozenset(), ids=None):
+        self.graph_kb = graph_kb
+        self.cached_bits = bits if ids is None else None
+        self.cached_ids = ids
+        self.complement = complement
+        self.others = others
+
+    @property
+    def bits(self):
+        if self.cached_bits is None:
+            self.cached_bits = ids_to_bits(self.cached_ids)
+        return self.cached_bits
+
+    @staticmethod
+    def from_values(graph_kb, values):
+        if isinstance(values, NodeSet):
+            return values
+        ids, others = [], []
+        for value in values:
+            node_id = graph_kb.node_ids.get(value)
+            if node_id is None:
+                others.append(value)
+            else:
+                ids.append(node_id)
+        return NodeSet(graph_kb, ids_to_bits(ids), others=frozenset(others))
+
+    def node_bits(self):
+        """Returns the bitset of the elements of the GraphKB in this set."""
+        if self.complement:
+            return ((1 << len(self.graph_kb.node_values)) - 1) & ~self.bits
+        return self.bits
+
+    def ids(self):
+        """Returns the sorted array of ids of the elements of the GraphKB in this set."""
+        if self.cached_ids is None or self.complement:
+            return bits_to_ids(self.node_bits())
+        return self.cached_ids
+
+    def canonical(self):
+        """Returns the elements of this set as a tuple sorted by their str()."""
+        if self.others:
+            return sorted_tuple(self)
+        ids = self.ids()
+        ids = ids[np.argsort(self.graph_kb.str_ranks()[ids], kind='stable')]
+        return tuple(self.graph_kb.decode(ids))
+
+    def intersection(self, other):
+        others = self.others & other.others
+        if self.complement and other.complement:
+            return NodeSet(self.graph_kb, self.bits | other.bits, True, others)
+        elif self.complement:
+            return NodeSet(self.graph_kb, other.bits & ~self.bits, False, others)
+        elif other.complement:
+            return NodeSet(self.graph_kb, self.bits & ~other.bits, False, others)
+        return NodeSet(self.graph_kb, self.bits & other.bits, False, others)
+
+    def union(self, other):
+        others = self.others | other.others
+        if self.complement and other.complement:
+            return NodeSet(self.graph_kb, self.bits & other.bits, True, others)
+        elif self.complement:
+            return NodeSet(self.graph_kb, self.bits & ~other.bits, True, others)
+        elif other.complement:
+            return NodeSet(self.graph_kb, other.bits & ~self.bits, True, others)
+        return NodeSet(self.graph_kb, self.bits | other.bits, False, others)
+
+    def complemented(self):
+        """Returns the set of elements of the GraphKB not in this set."""
+        return NodeSet(self.graph_kb, self.bits, not self.complement)
+
+    def __len__(self):
+        if self.cached_ids is not None and not self.complement:
+            return len(self.cached_ids) + len(self.others)
+        return bin(self.node_bits()).count('1') + len(self.others)
+
+    def __iter__(self):
+        for value in self.graph_kb.decode(self.ids()):
+            yield value
+        for value in self.others:
+            yield value
+
+def ids_to_bits(ids):
+    """Returns the Python int having bit k set for each id k in ids."""
+    if not len(ids):
+        return 0
+    mask = np.zeros(int(np.max(ids)) + 8, dtype=bool)
+    mask[ids] = True
+    packed = np.packbits(mask, bitorder='little')[::-1]
+    return int(binascii.hexlify(packed.tobytes()), 16)
+
+def bits_to_ids(bits):
+    """Returns the sorted array of the ids whose bits are set in bits."""
+    if not bits:
+        return EMPTY_IDS
+    digits = '%x' % bits
+    packed = np.frombuffer(binascii.unhexlify('0' * (len(digits) % 2) + digits), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed[::-1], bitorder='little'))
+
+
+class Predicate(object):
+    """
+    A predicate on values, the result of executing ('.gt', X), ('.lt', X) or
+    ('.eq', X): op is one of '.gt', '.lt' or '.eq', and value the number it
+    compares against.  Predicates are hashable and compare equal when their
+    op and value are equal.  Calling a Predicate applies it to a value, and
+    select() applies it to a whole sorted list of values at once.
+    """
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+    def __call__(self, x):
+        if self.op == '.gt':
+            return x > self.value
+        elif self.op == '.lt':
+            return x < self.value
+        else:
+            return x == self.value
+
+    def select(self, values):
+        """
+        Returns the range (start, end) of the positions of the given sorted
+        list of values which satisfy this predicate.
+        """
+        if self.op == '.gt':
+            return bisect_right(values, self.value), len(values)
+        elif self.op == '.lt':
+            return 0, bisect_left(values, self.value)
+        else:
+            return bisect_left(values, self.value), bisect_right(values, self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, Predicate) and (self.op, self.value) == (other.op, other.value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.op, self.value))
+
+    def __repr__(self):
+        return 'Predicate(%r, %r)' % (self.op, self.value)
+
 
 class GraphKBExecutor:
     """
@@ -156,11 +556,26 @@ class GraphKBExecutor:
         ('.argmax', Q, X)   the subset of [[X]] having maximal values under relation Q
         ('.argmin', Q, X)   the subset of [[X]] having minimal values under relation Q
 
+    execute() first compiles a query into a Plan, which is cached by the
+    query itself, so that executing the same query again skips
+    the dispatch on its structure.  evaluate() executes a query directly.
     """
     def __init__(self, graph_kb):
         self.graph_kb = graph_kb
+        self.plans = {}
+        self.plans_version = graph_kb.version
 
     def execute(self, sem):
+        denotation = self.plan(sem).run()
+        if isinstance(denotation, NodeSet):
+            return denotation.canonical()
+        return denotation
+
+    def evaluate(self, sem):
+        """
+        Like execute(), but sets of values are returned as NodeSets, in no
+        particular order, rather than as sorted tuples.
+        """
         if isinstance(sem, tuple):
             return self.execute_tuple(sem)
         elif isinstance(sem, str) and sem.startswith('.'):
@@ -185,75 +600,101 @@ class GraphKBExecutor:
             return self.execute_special(sem)
 
     def execute_unary(self, rel):
-        return sorted_tuple(self.graph_kb.unaries[rel])
+        return NodeSet(self.graph_kb, ids=self.graph_kb.unary(rel))
 
     def execute_binary(self, rel, arg, rev=False):
-        arg = self.execute(arg)
-        index = self.graph_kb.binaries_rev if rev else self.graph_kb.binaries_fwd
-        if isinstance(arg, Iterable):
+        return self.join(rel, self.evaluate(arg), rev)
+
+    def join(self, rel, arg, rev=False):
+        adjacency = self.graph_kb.adjacency(rel, rev)
+        if isinstance(arg, NodeSet):
+            vals = adjacency.join(arg.ids())
+        elif isinstance(arg, Iterable):
             # arg is a tuple, e.g., the result of executing '5044'.
-            vals = [src for dst in arg for src in index[rel][dst]]
-        elif isinstance(arg, FunctionType):
+            vals = adjacency.join(self.graph_kb.encode(arg))
+        elif isinstance(arg, Predicate):
             # arg is a predicate, e.g., the result of executing ('.gt', 5044).
-            vals = [src for dst, srcs in list(index[rel].items()) if arg(dst) for src in srcs]
+            value_index = self.graph_kb.value_index(rel, rev)
+            if value_index is not None and isinstance(arg.value, Number):
+                values, positions = value_index
+                start, end = arg.select(values)
+                keys = adjacency.sources[np.sort(positions[start:end])]
+            else:
+                keys = np.array([node_id for node_id in adjacency.sources
+                                 if arg(self.graph_kb.node_values[node_id])], dtype=np.int64)
+            vals = adjacency.join(keys)
         else:
             raise Exception('Unsupported argument to join: %s' % str(arg))
-        return sorted_tuple(set(vals))
+        return NodeSet(self.graph_kb, ids=vals)
+
+    def semijoin(self, rel, arg, candidates, rev=False):
+        """
+        Returns the intersection of candidates, a NodeSet, with the result of
+        join(rel, arg, rev), by following the edges of the candidates in the
+        opposite direction and keeping those which reach arg.
+        """
+        if not isinstance(arg, NodeSet) and not isinstance(arg, tuple):
+            return self.execute_and((candidates, self.join(rel, arg, rev)))
+        arg_ids = arg.ids() if isinstance(arg, NodeSet) else self.graph_kb.encode(arg)
+        srcs, dsts = self.graph_kb.adjacency(rel, not rev).edges(candidates.ids())
+        return NodeSet(self.graph_kb, ids=np.unique(srcs[np.isin(dsts, arg_ids)]))
 
     def execute_special(self, sem):
-        args = tuple([self.execute(elt) for elt in sem[1:]])
-        if sem[0] == '.and':
+        args = tuple([self.evaluate(elt) for elt in sem[1:]])
+        return self.execute_operator(sem[0], args)
+
+    def execute_operator(self, op, args):
+        if op == '.and':
             return self.execute_and(args)
-        elif sem[0] == '.or':
+        elif op == '.or':
             return self.execute_or(args)
-        elif sem[0] == '.not':
+        elif op == '.not':
             return self.execute_not(args)
-        elif sem[0] == '.any':
+        elif op == '.any':
             return self.execute_any(args)
-        elif sem[0] == '.count':
+        elif op == '.count':
             return self.execute_count(args)
-        elif sem[0] == '.gt':
+        elif op == '.gt':
             return self.execute_gt(args)
-        elif sem[0] == '.lt':
+        elif op == '.lt':
             return self.execute_lt(args)
-        elif sem[0] == '.eq':
+        elif op == '.eq':
             return self.execute_eq(args)
-        elif sem[0] == '.max':
+        elif op == '.max':
             return self.execute_max(args, rev=False, arg=False)
-        elif sem[0] == '.min':
+        elif op == '.min':
             return self.execute_max(args, rev=True, arg=False)
-        elif sem[0] == '.argmax':
+        elif op == '.argmax':
             return self.execute_max(args, rev=False, arg=True)
-        elif sem[0] == '.argmin':
+        elif op == '.argmin':
             return self.execute_max(args, rev=True, arg=True)
         else:
-            raise Exception('Unsupported operator: %s' % str(sem[0]))
+            raise Exception('Unsupported operator: %s' % str(op))
 
     def execute_and(self, args):
         assert len(args) == 2
         # Check to see if either element of args is a predicate,
         # e.g., the result of executing ('.gt', 5044).
-        if isinstance(args[0], FunctionType):
+        if isinstance(args[0], Predicate):
             args = (args[1], args[0])
-        if isinstance(args[1], FunctionType):
-            return sorted_tuple([elt for elt in args[0] if args[1](elt)])
+        if isinstance(args[1], Predicate):
+            return self.node_set([elt for elt in args[0] if args[1](elt)])
         else:
-            return sorted_tuple(set(args[0]).intersection(set(args[1])))
+            return self.node_set(args[0]).intersection(self.node_set(args[1]))
 
     # TODO: Properly handle the case where one or both arguments are
     # functions, like execute_and() does.
     def execute_or(self, args):
         assert len(args) == 2
-        return sorted_tuple(set(args[0]).union(set(args[1])))
+        return self.node_set(args[0]).union(self.node_set(args[1]))
 
     def execute_not(self, args):
         assert len(args) == 1
-        complement = [node for node in self.graph_kb.nodes if node not in args[0]]
-        return sorted_tuple(complement)
+        return self.node_set(args[0]).complemented()
 
     def execute_any(self, args):
         assert len(args) == 0
-        return self.execute_not(((),))
+        return NodeSet(self.graph_kb, complement=True)
 
     def execute_count(self, args):
         assert len(args) == 1
@@ -261,40 +702,164 @@ class GraphKBExecutor:
 
     def execute_gt(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
+        assert isinstance(args[0], (tuple, NodeSet)), 'Not a tuple: %s' % str(args[0])
         max_val = max(args[0]) if args[0] else float('-inf')
-        return lambda x: x > max_val
+        return Predicate('.gt', max_val)
 
     # TODO: consider ways of combining with execute_gt().
     def execute_lt(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
+        assert isinstance(args[0], (tuple, NodeSet)), 'Not a tuple: %s' % str(args[0])
         min_val = min(args[0]) if args[0] else float('inf')
-        return lambda x: x < min_val
+        return Predicate('.lt', min_val)
 
     def execute_eq(self, args):
         assert len(args) == 1
-        assert isinstance(args[0], tuple), 'Not a tuple: %s' % str(args[0])
+        assert isinstance(args[0], (tuple, NodeSet)), 'Not a tuple: %s' % str(args[0])
         assert len(args[0]) == 1
-        return lambda x: x == args[0][0]
+        return Predicate('.eq', list(args[0])[0])
 
     def execute_max(self, args, rev=False, arg=False):
         assert len(args) == 2
         # TODO: Drop the assumption that the first argument is a relation from some entity
         # to a number.  What if it's the other way around?
-        index = self.graph_kb.binaries_fwd
-        assert args[0] in index, 'Not a relation name: %s' % str(args[0])
-        pairs = [(src, dst) for src in args[1] for dst in index[args[0]][src]]
+        assert args[0] in self.graph_kb.binaries_fwd, 'Not a relation name: %s' % str(args[0])
+        adjacency = self.graph_kb.adjacency(args[0])
+        srcs, dsts = adjacency.edges(self.node_set(args[1]).ids())
+        pairs = list(zip(self.graph_kb.decode(srcs), self.graph_kb.decode(dsts)))
         vals = [val for e, val in pairs]
         if rev:
             ext_val = min(vals) if pairs else float('inf')
         else:
             ext_val = max(vals) if pairs else float('-inf')
         if arg:
-            return sorted_tuple(set([e for e, val in pairs if val == ext_val]))
+            return self.node_set([e for e, val in pairs if val == ext_val])
         else:
             return (ext_val,)
 
+    def node_set(self, values):
+        return NodeSet.from_values(self.graph_kb, values)
+
+    # Query plans ------------------------------------------------------------
+
+    def plan(self, sem):
+        """Returns the Plan for the given query, compiling it if need be."""
+        if self.plans_version != self.graph_kb.version:
+            self.plans = {}
+            self.plans_version = self.graph_kb.version
+        try:
+            plan = self.plans.get(sem)
+        except TypeError:
+            # The query is not hashable, e.g. it contains a list, so it cannot
+            # be cached.
+            return self.compile(sem)
+        if plan is None:
+            if len(self.plans) >= MAX_PLANS:
+                self.plans.clear()
+            plan = self.compile(sem)
+            self.plans[sem] = plan
+        return plan
+
+    def compile(self, sem):
+        """
+        Returns a Plan which evaluates the given query.  Queries which cannot be
+        compiled, e.g. because they are malformed, get a Plan which evaluates
+        them directly, so that they fail at execution time just as before.
+        """
+        try:
+            return self.compile_query(sem)
+        except Exception:
+            return Plan(lambda: self.evaluate(sem))
+
+    def compile_query(self, sem):
+        # The same dispatch as evaluate() and execute_tuple().
+        unaries, binaries = self.graph_kb.unaries, self.graph_kb.binaries_fwd
+        if isinstance(sem, tuple):
+            if len(sem) == 1 and sem[0] in unaries:
+                return self.compile_constant(self.execute_unary(sem[0]))
+            elif len(sem) == 2 and sem[0] in binaries:
+                return self.compile_join(sem[0], sem[1], rev=True)
+            elif len(sem) == 2 and sem[1] in binaries:
+                return self.compile_join(sem[1], sem[0], rev=False)
+            elif sem[0].startswith('.'):
+                return self.compile_operator(sem)
+            else:
+                return Plan(lambda: None)
+        elif isinstance(sem, str) and sem.startswith('.'):
+            return self.compile_operator((sem,))
+        elif sem in unaries:
+            return self.compile_constant(self.execute_unary(sem))
+        elif sem in binaries:
+            return Plan(lambda: sem)
+        else:
+            return self.compile_constant((sem,))
+
+    def compile_constant(self, value):
+        return Plan(lambda: value, estimate=len(value))
+
+    def compile_join(self, rel, arg, rev):
+        arg_plan = self.compile(arg)
+        adjacency = self.graph_kb.adjacency(rel, rev)
+        estimate = adjacency.num_targets
+        if arg_plan.estimate is not None:
+            fanout = float(len(adjacency)) / max(len(adjacency.sources), 1)
+            estimate = min(estimate, arg_plan.estimate * fanout)
+        return Plan(lambda: self.join(rel, arg_plan.run(), rev),
+                    estimate=estimate, join=(rel, arg_plan, rev))
+
+    def compile_operator(self, sem):
+        op = sem[0]
+        arg_plans = [self.compile(elt) for elt in sem[1:]]
+        estimates = [arg_plan.estimate for arg_plan in arg_plans]
+        if op == '.and' and len(arg_plans) == 2 and None not in estimates:
+            return self.compile_and(*arg_plans)
+        estimate = None
+        if op == '.or' and None not in estimates:
+            estimate = sum(estimates)
+        elif (op, len(arg_plans)) in (('.not', 1), ('.any', 0)):
+            estimate = len(self.graph_kb.node_values)
+        elif (op, len(arg_plans)) in (('.count', 1), ('.max', 2), ('.min', 2)):
+            estimate = 1
+        elif op in ('.argmax', '.argmin') and len(arg_plans) == 2:
+            estimate = arg_plans[1].estimate
+        def run():
+            return self.execute_operator(op, tuple([arg_plan.run() for arg_plan in arg_plans]))
+        return Plan(run, estimate=estimate)
+
+    def compile_and(self, left, right):
+        """
+        Returns a Plan for the intersection of two sets, which evaluates the
+        more selective side first and, if the other side is a join, uses it to
+        restrict the join with semijoin().
+        """
+        if right.estimate < left.estimate:
+            left, right = right, left
+        if right.join is not None:
+            rel, arg_plan, rev = right.join
+            def run():
+                candidates = self.node_set(left.run())
+                return self.semijoin(rel, arg_plan.run(), candidates, rev)
+        else:
+            def run():
+                return self.execute_and((left.run(), right.run()))
+        return Plan(run, estimate=left.estimate)
+
+MAX_PLANS = 100000
+
+class Plan(object):
+    """
+    A compiled query.  run() evaluates it, and estimate is an estimate of the
+    number of values in its result, or None if it is not a set of values,
+    e.g. if it is a relation name or a Predicate.  For a join, join is the
+    triple (rel, arg plan, rev).
+    """
+    __slots__ = ['run', 'estimate', 'join']
+
+    def __init__(self, run, estimate=None, join=None):
+        self.run = run
+        self.estimate = estimate
+        self.join = join
+
 def sorted_tuple(elements):
     return tuple(sorted(list(elements), key=str))
 
@@ -6,16 +6,19 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+import math
+import multiprocessing
 import random
 from collections import defaultdict
 
+import numpy as np
+
+from forest import expected_rule_counts, kbest_parses, log_add, parse_forest, topological_nodes
 from metrics import SemanticsAccuracyMetric, DenotationAccuracyMetric
-from scoring import Model
+from parsing import ForkWorkers, RuleScores, parse_fingerprint, uses_beam
+from scoring import FeatureMatrix, Model, rule_counts, rule_feature, rule_score
 
 def latent_sgd(model=None, examples=[], training_metric=None, T=10, eta=0.1, seed=None):
-    # Used for sorting scored parses.
-    def scored_parse_key_fn(scored_parse):
-        return (scored_parse[0], str(scored_parse[1]))
     if T <= 0:
         return model
     print('=' * 80)
@@ -25,22 +28,16 @@ def latent_sgd(model=None, examples=[], training_metric=None, T=10, eta=0.1, see
         print('random.seed(%d)' % seed)
         random.seed(seed)
     model = clone_model(model)
+    parse_cache = {}
     for t in range(T):
         random.shuffle(examples)
         num_correct = 0
         for example in examples:
-            # Reparse with current weights.
-            parses = model.parse_input(example.input)
-            # Get the highest-scoring "good" parse among the candidate parses.
-            good_parses = [p for p in parses if training_metric.evaluate(example, [p])]
-            if good_parses:
-                target_parse = good_parses[0]
-                # Get all (score, parse) pairs.
-                scores = [(p.score + cost(target_parse, p), p) for p in parses]
-                # Get the maximal score.
-                max_score = sorted(scores, key=scored_parse_key_fn)[-1][0]
-                # Get all the candidates with the max score and choose one randomly.
-                predicted_parse = random.choice([p for s, p in scores if s == max_score])
+            # Rescore with current weights.
+            parses = parse_with_cache(model, example, parse_cache)
+            chosen = choose_parses(example, parses, training_metric, random)
+            if chosen:
+                target_parse, predicted_parse = chosen
                 if training_metric.evaluate(example, [predicted_parse]):
                     num_correct += 1
                 update_weights(model, target_parse, predicted_parse, eta)
@@ -48,24 +45,314 @@ def latent_sgd(model=None, examples=[], training_metric=None, T=10, eta=0.1, see
     print_weights(model.weights)
     return model
 
+def choose_parses(example, parses, training_metric, rng):
+    """
+    Returns the pair (target parse, predicted parse) for one step of latent
+    SGD, or None if none of the parses is good according to the training
+    metric.  Ties for the predicted parse are broken with rng.choice().
+    """
+    # Used for sorting scored parses.
+    def scored_parse_key_fn(scored_parse):
+        return (scored_parse[0], parse_fingerprint(scored_parse[1]))
+    # Get the highest-scoring "good" parse among the candidate parses.
+    good_parses = [p for p in parses if training_metric.evaluate(example, [p])]
+    if not good_parses:
+        return None
+    target_parse = good_parses[0]
+    # Get all (score, parse) pairs.
+    scores = [(p.score + cost(target_parse, p), p) for p in parses]
+    # Get the maximal score.
+    max_score = sorted(scores, key=scored_parse_key_fn)[-1][0]
+    # Get all the candidates with the max score and choose one randomly.
+    predicted_parse = rng.choice([p for s, p in scores if s == max_score])
+    return target_parse, predicted_parse
+
+def parallel_latent_sgd(model=None, examples=[], training_metric=None, T=10, eta=0.1,
+                        seed=None, processes=None, mixing='minibatch', batch_size=64):
+    """
+    A data-parallel version of latent_sgd, whose examples are parsed and
+    decoded by worker processes (see parsing.ForkWorkers), forked once for the
+    whole run.  Each example is always assigned to the same worker, which keeps
+    the parses of its examples (see parse_with_cache()) and its own copy of the
+    weights.  Workers send back only sparse updates, and the coordinator sends
+    each worker only the changes it has since made to the weights.  With mixing
+    'minibatch', each batch of batch_size examples is decoded in parallel under
+    the same weights, and the coordinator applies the average of their
+    updates.  With mixing 'ipm' (iterative parameter mixing), each epoch each
+    worker runs ordinary SGD over its examples, and the coordinator averages
+    the resulting changes to the weights.  Each example gets its own random
+    number generator in each epoch, seeded from seed, so that with mixing
+    'minibatch' the result does not depend on the number of processes.
+    """
+    assert mixing in ('minibatch', 'ipm'), mixing
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running parallel SGD learning (%s) on %d examples with training metric: %s\n' % (
+        mixing, len(examples), training_metric.name()))
+    model = clone_model(model)
+    num_workers = min(processes or multiprocessing.cpu_count(), len(examples)) or 1
+    def example_rng(t, index):
+        return random.Random(hash((seed or 0, t, index)))
+    # The state of each worker, inherited when it is forked.
+    worker_model = clone_model(model, weights=model.weights)
+    parse_cache = {}
+    def decode_example(t, index):
+        example = examples[index]
+        parses = parse_with_cache(worker_model, example, parse_cache)
+        chosen = choose_parses(example, parses, training_metric, example_rng(t, index))
+        if not chosen:
+            return False, {}
+        target_parse, predicted_parse = chosen
+        return (training_metric.evaluate(example, [predicted_parse]),
+                feature_updates(worker_model, target_parse, predicted_parse))
+    def work(message):
+        t, changes, indexes = message
+        for f, change in list(changes.items()):
+            worker_model.weights[f] += change
+        if mixing == 'minibatch':
+            return [decode_example(t, index) for index in indexes]
+        # Run SGD over the worker's examples, then restore its weights, which
+        # the coordinator will update with the average of the workers' changes.
+        start_weights = dict(worker_model.weights.items())
+        num_correct = 0
+        for index in indexes:
+            correct, updates = decode_example(t, index)
+            num_correct += correct
+            if updates:
+                mix_updates(worker_model, [updates], eta)
+        changes = {}
+        for key, value in list(worker_model.weights.items()):
+            change = value - start_weights.get(key, 0.0)
+            if change != 0.0:
+                changes[key] = change
+                worker_model.weights[key] = start_weights.get(key, 0.0)
+        return num_correct, changes
+    workers = ForkWorkers(work, num_workers)
+    try:
+        order = list(range(len(examples)))
+        shuffler = random.Random(seed)
+        changes = {}
+        for t in range(T):
+            shuffler.shuffle(order)
+            if mixing == 'minibatch':
+                batches = [order[start:start + batch_size]
+                           for start in range(0, len(order), batch_size)]
+                results = []
+                for batch in batches:
+                    shards = [[index for index in batch if index % num_workers == w]
+                              for w in range(num_workers)]
+                    shard_results = workers.map([(t, changes, shard) for shard in shards])
+                    # Put the results back in batch order, so that the updates
+                    # are summed in the same order by any number of workers.
+                    by_index = {}
+                    for shard, shard_result in zip(shards, shard_results):
+                        by_index.update(list(zip(shard, shard_result)))
+                    batch_results = [by_index[index] for index in batch]
+                    changes = mix_updates(model, [updates for correct, updates in batch_results],
+                                          eta / len(batch))
+                    results.extend(batch_results)
+            else:
+                shards = [[index for index in order if index % num_workers == w]
+                          for w in range(num_workers)]
+                results = workers.map([(t, changes, shard) for shard in shards])
+                changes = mix_updates(model, [changes for num_correct, changes in results],
+                                      1.0 / num_workers)
+            num_correct = sum([correct for correct, updates in results])
+            print('SGD iteration %d: train accuracy: %.3f' % (t, 1.0 * num_correct / len(examples)))
+    finally:
+        workers.close()
+    print_weights(model.weights)
+    return model
+
+def mix_updates(model, updates_list, scale):
+    """
+    Adds scale times each of the given sparse updates to the weights of the
+    model, and returns the resulting changes to the weights.
+    """
+    total = defaultdict(float)
+    for updates in updates_list:
+        for f, update in list(updates.items()):
+            total[f] += update
+    changes = {}
+    for f, update in list(total.items()):
+        changes[f] = scale * update
+        model.weights[f] += changes[f]
+    return changes
+
+def forest_sgd(model=None, examples=[], training_metric=None, T=10, eta=0.1, seed=None, k=100):
+    """
+    Trains the weights of rule features (see scoring.rule_features()) by
+    stochastic gradient ascent on the conditional log-likelihood of the correct
+    derivations of each example, that is, of the log-linear distribution over
+    all its derivations.  The gradient for an example is the expected rule
+    counts over its correct derivations minus those over all its derivations.
+    The latter, and the log normalizer, are computed exactly by inside-outside
+    over the packed forest of the example (see forest.parse_forest()), whose
+    size is polynomial in the length of the input, so the derivations are
+    never enumerated.  Whether a derivation is correct depends on its
+    semantics, which the forest does not track, so the correct derivations
+    are sought only among the k best derivations under the current weights
+    (see forest.kbest_parses()), which are post-processed by the grammar's
+    finish_parses() and judged by the training metric.  An example with no
+    correct derivation among them contributes no update, and the number of
+    such examples is reported for each iteration.  Other features of
+    model.feature_fn are ignored, and so is any beam.
+    """
+    if T <= 0:
+        return model
+    print('=' * 80)
+    print('Running forest SGD learning on %d examples with training metric: %s\n' % (
+        len(examples), training_metric.name()))
+    if seed:
+        print('random.seed(%d)' % seed)
+        random.seed(seed)
+    model = clone_model(model)
+    # The forests do not depend on the weights, so they are built only once,
+    # and whether a derivation is correct is judged only once.  forests maps
+    # the id of each example to its forest, the forest's nodes in topological
+    # order, and a map from the fingerprint of each derivation judged so far
+    # to whether it is correct.
+    forests = {}
+    for t in range(T):
+        random.shuffle(examples)
+        num_correct = 0
+        num_missed = 0
+        log_likelihood = 0.0
+        for example in examples:
+            if id(example) not in forests:
+                forest = parse_forest(model.grammar, example.input)
+                forests[id(example)] = (forest, topological_nodes(forest), {})
+            forest, nodes, judgments = forests[id(example)]
+            rule_scores = RuleScores(lambda rule: rule_score(rule, model.weights))
+            log_z, counts = expected_rule_counts(forest, rule_scores.__getitem__, nodes)
+            parses = kbest_parses(forest, k, rule_scores.__getitem__)
+            finished = model.grammar.finish_parses(example.input, parses)
+            correct_parses = []
+            for parse, finished_parse in zip(parses, finished):
+                fingerprint = parse_fingerprint(parse)
+                if fingerprint not in judgments:
+                    if model.executor:
+                        finished_parse.denotation = model.executor(finished_parse.semantics)
+                    judgments[fingerprint] = training_metric.evaluate(example, [finished_parse])
+                if judgments[fingerprint]:
+                    correct_parses.append(parse)
+            if not correct_parses:
+                num_missed += 1
+                continue
+            if correct_parses[0] is parses[0]:
+                num_correct += 1
+            # The expected rule counts over the correct derivations found.
+            scored_counts = []
+            log_z_correct = float('-inf')
+            for parse in correct_parses:
+                parse_counts = rule_counts(parse)
+                score = sum([rule_scores[rule] * count
+                             for rule, count in list(parse_counts.items())])
+                scored_counts.append((score, parse_counts))
+                log_z_correct = log_add(log_z_correct, score)
+            log_likelihood += log_z_correct - log_z
+            updates = defaultdict(float)
+            for score, parse_counts in scored_counts:
+                probability = math.exp(score - log_z_correct)
+                for rule, count in list(parse_counts.items()):
+                    updates[rule_feature(rule)] += probability * count
+            for rule, count in list(counts.items()):
+                updates[rule_feature(rule)] -= count
+            for f, update in list(updates.items()):
+                if update != 0.0:
+                    model.weights[f] += eta * update
+        print('SGD iteration %d: train accuracy: %.3f, log-likelihood: %.3f, '
+              'no correct parse among the %d best: %d' % (
+                  t, 1.0 * num_correct / len(examples), log_likelihood, k, num_missed))
+    print_weights(model.weights)
+    return model
+
+def parse_with_cache(model, example, cache):
+    """
+    Returns the same list of parses as model.parse_input(example.input), but
+    builds the parses only the first time it is called for a given example;
+    after that, it only rescores them with the current weights.  If the model
+    sets rerank_k, the parses are ranked by their coarse features, which are
+    computed once, and only the best rerank_k are returned, as in
+    Model.score_parses().  A parse is executed and its features computed the
+    first time it is returned.  cache maps the id of each example to a list:
+    its parses, in the order given by the parser, the FeatureMatrix of their
+    coarse features (or None), a map from the index of each parse returned so
+    far to its features, and the indexes of the parses last returned and their
+    FeatureMatrix.  In beam mode, the parses themselves depend on the weights,
+    so the example is reparsed.
+    """
+    if uses_beam(model.grammar):
+        return model.parse_input(example.input)
+    entry = cache.get(id(example))
+    if entry is None:
+        parses = model.grammar.parse_input(example.input)
+        coarse_features = None
+        if model.rerank_k is not None:
+            coarse_feature_fn = model.coarse_feature_fn or model.feature_fn
+            coarse_features = FeatureMatrix([coarse_feature_fn(parse) for parse in parses],
+                                            model.feature_index, add=True)
+        entry = [parses, coarse_features, {}, None, None]
+        cache[id(example)] = entry
+    parses, coarse_features, parse_features, last_ranked, features = entry
+    if coarse_features is None:
+        ranked = list(range(len(parses)))
+    else:
+        coarse_scores = coarse_features.dot(model.weights)
+        # A stable sort on the indexes, so that ties keep parser order.
+        ranked = sorted(range(len(parses)), key=lambda i: coarse_scores[i], reverse=True)
+        ranked = ranked[:model.rerank_k]
+    if ranked != last_ranked:
+        for i in ranked:
+            if i not in parse_features:
+                if model.executor:
+                    parses[i].denotation = model.executor(parses[i].semantics)
+                parse_features[i] = model.feature_fn(parses[i])
+        features = FeatureMatrix([parse_features[i] for i in ranked],
+                                 model.feature_index, add=True)
+        entry[3:] = [ranked, features]
+    ranked_parses = [parses[i] for i in ranked]
+    for parse, score in zip(ranked_parses, features.dot(model.weights)):
+        parse.score = float(score)
+    # Sorting is stable, so ties are broken by parser order, as in Model.
+    return sorted(ranked_parses, key=lambda parse: parse.score, reverse=True)
+
 def cost(parse_1, parse_2):
     return 0.0 if parse_1 == parse_2 else 1.0
 
-def clone_model(model):
+def clone_model(model, weights=None):
     return Model(grammar=model.grammar,
                  feature_fn=model.feature_fn,
-                 weights=defaultdict(float),  # Zero the weights.
-                 executor=model.executor)
+                 weights=weights or defaultdict(float),  # By default, zero the weights.
+                 executor=model.executor,
+                 coarse_feature_fn=model.coarse_feature_fn,
+                 rerank_k=model.rerank_k)
 
-def update_weights(model, target_parse, predicted_parse, eta):
+def feature_updates(model, target_parse, predicted_parse):
+    """
+    Returns a map from each feature whose value differs between the target and
+    predicted parses to the difference.
+    """
     target_features = model.feature_fn(target_parse)
     predicted_features = model.feature_fn(predicted_parse)
+    updates = {}
     for f in set(list(target_features.keys()) + list(predicted_features.keys())):
-        update = target_features[f] - predicted_features[f]
+        update = target_features.get(f, 0.0) - predicted_features.get(f, 0.0)
         if update != 0.0:
-            # print 'update %g + %g * %g = %g\t%s' % (
-            #     model.weights[f], eta, update, model.weights[f] + eta * update, f)
-            model.weights[f] += eta * update
+            updates[f] = update
+    return updates
+
+def update_weights(model, target_parse, predicted_parse, eta):
+    updates = feature_updates(model, target_parse, predicted_parse)
+    if updates:
+        # print 'update %g + %g * %g = %g\t%s' % (
+        #     model.weights[f], eta, update, model.weights[f] + eta * update, f)
+        feature_ids = [model.feature_index.add(f) for f in updates]
+        # Each feature occurs at most once, so this is a plain scatter-add.
+        weights = model.weights
+        weights.array = weights.dense(max(feature_ids) + 1)
+        weights.array[feature_ids] += eta * np.array(list(updates.values()))
 
 def print_weights(weights, n=20):
     pairs = [(value, str(key)) for key, value in list(weights.items()) if value != 0]
@@ -6,6 +6,8 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+from parsing import semantics_fingerprint
+
 # An evaluation metric is a function that takes a list of parses and an example,
 # and returns a number.
 class Metric:
@@ -84,7 +86,7 @@ class SpuriousAmbiguityMetric(Metric):
     def evaluate(self, example, parses):
         if len(parses) == 1:
             return 0.0
-        sems = set([str(parse.semantics) for parse in parses])
+        sems = set([semantics_fingerprint(parse.semantics) for parse in parses])
         # This conditional should be redundant with the final line.
         # But without it, we can return -0.0, which looks weird.
         if len(sems) == len(parses):
@@ -19,25 +19,63 @@ __version__ = "0.9"
 __maintainer__ = "Bill MacCartney"
 __email__ = "See the author's website"
 
+import hashlib
+import heapq
 import math
-from collections import defaultdict, Iterable
-from itertools import product
+import multiprocessing
+import traceback
+from collections import OrderedDict, defaultdict, Iterable
 from six import StringIO
 from types import FunctionType
 
+from annotator import Annotator
+
 MAX_CELL_CAPACITY = 1000  # upper bound on number of parses in one chart cell
 
+# If true, every Rule and Parse is checked for well-formedness as it is built
+# (see validate_rule() and validate_parse()).  The checks are useful while
+# writing a grammar, but cost time in the chart-filling loop, so set this to
+# False once the grammar is known to be sound.
+VALIDATE = True
+
+
+# Symbols ======================================================================
+
+# Every category and terminal is assigned a small integer id the first time it
+# is seen.  The ids are global rather than per-grammar, because the same Rule
+# objects are routinely shared among several grammars.
+symbol_ids = {}
+symbols = []
+
+def intern_symbol(label):
+    """Returns the integer id of the given category or terminal."""
+    symbol_id = symbol_ids.get(label)
+    if symbol_id is None:
+        symbol_id = len(symbols)
+        symbol_ids[label] = symbol_id
+        symbols.append(label)
+    return symbol_id
+
 
 # Rule =========================================================================
 
-class Rule:
+class Rule(object):
     """Represents a CFG rule with a semantic attachment."""
 
+    # fingerprint and feature are left unset until they are first needed (see
+    # rule_fingerprint() and scoring.rule_feature()).
+    __slots__ = ('lhs', 'rhs', 'sem', 'lhs_id', 'fingerprint', 'feature')
+
     def __init__(self, lhs, rhs, sem=None):
         self.lhs = lhs
         self.rhs = tuple(rhs.split()) if isinstance(rhs, str) else rhs
         self.sem = sem
-        validate_rule(self)
+        # Only the lhs is interned here.  Annotators create a Rule for every
+        # span they annotate, and interning those terminals would make the
+        # symbol table grow with every new input.
+        self.lhs_id = intern_symbol(self.lhs)
+        if VALIDATE:
+            validate_rule(self)
 
     def __str__(self):
         """Returns a string representation of this Rule."""
@@ -92,14 +130,30 @@ def contains_optionals(rule):
 
 # Parse ========================================================================
 
-class Parse:
+class Parse(object):
+    # Slots keep parses small, since the chart holds very many of them.
+    # semantics, inside_score and fingerprint are left unset until they are
+    # needed, and alternatives is set only by dedup_cell().
+    __slots__ = ('rule', 'children', 'score', 'denotation', 'semantics', 'inside_score',
+                 'fingerprint', 'alternatives')
+
     def __init__(self, rule, children):
         self.rule = rule
-        self.children = tuple(children[:])
-        self.semantics = compute_semantics(self)
+        self.children = tuple(children)
         self.score = float('NaN')
         self.denotation = None
-        validate_parse(self)
+        if VALIDATE:
+            validate_parse(self)
+
+    def __getattr__(self, name):
+        # Called only for unset slots.  Semantics are computed on first access
+        # rather than at construction, since most parses built while filling
+        # the chart are never inspected.  They are interned, so that equal
+        # semantics built by different parses are shared.
+        if name == 'semantics':
+            self.semantics = intern_semantics(compute_semantics(self))
+            return self.semantics
+        raise AttributeError(name)
 
     def __str__(self):
         child_strings = [str(child) for child in self.children]
@@ -132,6 +186,94 @@ def compute_semantics(parse):
         child_semantics = [child.semantics for child in parse.children]
         return apply_semantics(parse.rule, child_semantics)
 
+
+# Fingerprints =================================================================
+
+# A fingerprint is a short string which identifies a parse or a semantic value
+# by its structure.  Unlike str(), it is computed bottom-up and remembered, so
+# comparing two parses or two semantics by fingerprint takes constant time
+# rather than time proportional to their size.  Fingerprints are digests, so
+# they do not depend on the process's hash seed.
+
+def digest(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def rule_fingerprint(rule):
+    try:
+        return rule.fingerprint
+    except AttributeError:
+        rule.fingerprint = digest(str(rule))
+        return rule.fingerprint
+
+def parse_fingerprint(parse):
+    """
+    Returns the fingerprint of the given parse, which is the same for any two
+    parses which use the same rules in the same way over the same tokens.
+    """
+    try:
+        return parse.fingerprint
+    except AttributeError:
+        parts = [rule_fingerprint(parse.rule)]
+        for child in parse.children:
+            if isinstance(child, Parse):
+                parts.append(parse_fingerprint(child))
+            else:
+                parts.append(repr(child))
+        parse.fingerprint = digest(' '.join(parts))
+        return parse.fingerprint
+
+# Interned semantic values.  Tuples and frozensets (which cannot change once
+# built) are interned: interned_semantics maps the fingerprint of each to its
+# canonical instance, and semantics_fingerprints maps the id of each canonical
+# instance to the pair (instance, fingerprint).  Since a semantic tuple is
+# usually built from the interned semantics of child parses, its fingerprint
+# takes time proportional only to its length.  The tables are cleared when
+# they reach MAX_INTERNED_SEMANTICS entries, so that they do not grow without
+# bound in a long-running process.
+MAX_INTERNED_SEMANTICS = 100000
+interned_semantics = {}
+semantics_fingerprints = {}
+
+def semantics_fingerprint(sem):
+    """
+    Returns the fingerprint of the given semantic value, which is the same for
+    any two equal values built from tuples, lists, dicts, sets and atoms.
+    """
+    entry = semantics_fingerprints.get(id(sem))
+    if entry is not None and entry[0] is sem:
+        return entry[1]
+    if isinstance(sem, (tuple, list)):
+        parts = [semantics_fingerprint(item) for item in sem]
+    elif isinstance(sem, dict):
+        parts = sorted([semantics_fingerprint(key) + ':' + semantics_fingerprint(value)
+                        for key, value in list(sem.items())])
+    elif isinstance(sem, (set, frozenset)):
+        parts = sorted([semantics_fingerprint(item) for item in sem])
+    else:
+        parts = [repr(sem)]
+    return digest(type(sem).__name__ + '(' + ' '.join(parts) + ')')
+
+def intern_semantics(sem):
+    """
+    Returns the canonical instance of the given semantic value, if it is a tuple
+    or frozenset, and otherwise the value itself.
+    """
+    if not isinstance(sem, (tuple, frozenset)):
+        return sem
+    entry = semantics_fingerprints.get(id(sem))
+    if entry is not None and entry[0] is sem:
+        return sem
+    fingerprint = semantics_fingerprint(sem)
+    canonical = interned_semantics.get(fingerprint)
+    if canonical is None:
+        if len(interned_semantics) >= MAX_INTERNED_SEMANTICS:
+            interned_semantics.clear()
+            semantics_fingerprints.clear()
+        canonical = sem
+        interned_semantics[fingerprint] = canonical
+        semantics_fingerprints[id(canonical)] = (canonical, fingerprint)
+    return canonical
+
 def parse_to_pretty_string(parse, indent=0, show_sem=False):
     def indent_string(level):
         return '  ' * level
@@ -166,26 +308,86 @@ def parse_to_pretty_string(parse, indent=0, show_sem=False):
 # Grammar ======================================================================
 
 class Grammar:
-    def __init__(self, rules=[], annotators=[], start_symbol='$ROOT'):
+    """
+    A grammar is a collection of rules and annotators.  If beam_width or
+    category_beam_width is set, the grammar parses in beam mode: parses are
+    scored as the chart is built (see score_parses()), and each chart cell
+    keeps at most beam_width parses, and at most category_beam_width parses of
+    any one category, retaining the best-scoring ones.  If span_cache_size is
+    set, complete chart cells are cached across inputs (see SpanCache).  If
+    semantic_dedup is 'best' or 'pack', parses of the same span with the same
+    category and semantics are merged as the chart is built (see dedup_cell()).
+    """
+    def __init__(self, rules=[], annotators=[], start_symbol='$ROOT',
+                 beam_width=None, category_beam_width=None, span_cache_size=None,
+                 semantic_dedup=None):
+        assert semantic_dedup in (None, 'best', 'pack'), semantic_dedup
         self.categories = set()
         self.lexical_rules = defaultdict(list)
         self.unary_rules = defaultdict(list)
         self.binary_rules = defaultdict(list)
         self.annotators = annotators
         self.start_symbol = start_symbol
+        self.beam_width = beam_width
+        self.category_beam_width = category_beam_width
+        self.semantic_dedup = semantic_dedup
+        self.compiled = None
+        self.frozen = False
+        self.span_cache = SpanCache(span_cache_size) if span_cache_size else None
         for rule in rules:
             add_rule(self, rule)
         print('Created grammar with %d rules' % len(rules))
+        compile_grammar(self)
 
-    def parse_input(self, input):
+    def parse_input(self, input, rule_score_fn=None):
         """
         Returns the list of parses for the given input which can be derived
         using this grammar.
         """
-        return parse_input(self, input)
+        return self.finish_parses(input, parse_input(self, input, rule_score_fn))
+
+    def finish_parses(self, input, parses):
+        """
+        Returns the given parses of the given input, as built by the chart
+        parser, in the form in which parse_input() returns them.  By default,
+        they are returned unchanged.  A grammar which post-processes its parses
+        should override this rather than parse_input(), so that the parses
+        found in other ways (by k-best extraction, an IncrementalParser or a
+        forest SGD) are post-processed too.  The given parses may still be
+        held by a chart or a SpanCache, so an override should return new parses
+        rather than change them, one for each given parse, in the same order.
+        """
+        return parses
+
+    def parse_batch(self, inputs, rule_score_fn=None, processes=None):
+        """
+        Returns a list holding the list of parses for each of the given inputs,
+        in order, parsing the inputs in parallel.  See fork_map().
+        """
+        compiled = compile_grammar(self)
+        def parse_one(input):
+            return encode_parses(compiled, self.parse_input(input, rule_score_fn))
+        return [decode_parses(compiled, encoding)
+                for encoding in fork_map(parse_one, inputs, processes)]
+
+    def freeze(self):
+        """Makes this grammar read-only.  See freeze_grammar()."""
+        freeze_grammar(self)
+
+def uses_beam(grammar):
+    """Returns true iff the given grammar parses in beam mode."""
+    return (getattr(grammar, 'beam_width', None) is not None or
+            getattr(grammar, 'category_beam_width', None) is not None)
 
 def add_rule(grammar, rule):
-    if contains_optionals(rule):
+    if getattr(grammar, 'frozen', False):
+        raise Exception('Cannot add a rule to a frozen grammar: %s' % rule)
+    grammar.compiled = None  # any compiled form is now stale
+    if getattr(grammar, 'span_cache', None) is not None:
+        grammar.span_cache.clear()  # and so are any cached cells
+    if contains_optionals(rule) and all([is_cat(strip_optional(rhsi)) for rhsi in rule.rhs]):
+        add_rule_with_optional_categories(grammar, rule)
+    elif contains_optionals(rule):
         add_rule_containing_optional(grammar, rule)
     elif is_lexical(rule):
         grammar.lexical_rules[rule.rhs].append(rule)
@@ -234,6 +436,104 @@ def add_rule_containing_optional(grammar, rule):
         sem = lambda sems: rule.sem(sems[:first] + [None] + sems[first:])
     add_rule(grammar, Rule(rule.lhs, prefix + suffix, sem))
 
+def strip_optional(label):
+    return label[1:] if is_optional(label) else label
+
+def add_rule_with_optional_categories(grammar, rule):
+    """
+    Handles adding a rule whose RHS consists of categories, some of which are
+    optional.  Rather than expanding the rule into one variant for each subset
+    of its optional elements (2^k variants for k optional elements), we add at
+    most a quadratic number of binary rules, sharing intermediate categories
+    among the variants.  For each position q, we introduce (if needed) a new
+    category covering the elements of the RHS from position q onward, in any
+    realization which includes element q and at least one later element.  Each
+    rule skips over any optional elements between the two elements it joins.
+    The new categories carry the list of the semantics of their elements, with
+    None in each skipped position, and the original semantics is applied just
+    once, to the complete list.
+
+    For example, if the original rule is:
+
+        Rule('$Z', '?$A $B ?$C')
+
+    then we create a new category '$Z_$A' (covering '$B $C'), and add these
+    rules instead:
+
+        Rule('$Z', '$A $B')         # sem receives [a, b, None]
+        Rule('$Z', '$A $Z_$A')      # sem receives [a, b, c]
+        Rule('$Z_$A', '$B $C')      # [b, c]
+        Rule('$Z', '$B $C')         # sem receives [None, b, c]
+        Rule('$Z', '$B')            # sem receives [None, b, None]
+    """
+    rhs = tuple([strip_optional(rhsi) for rhsi in rule.rhs])
+    optional = [is_optional(rhsi) for rhsi in rule.rhs]
+    n = len(rhs)
+    assert not all(optional), 'Entire RHS is optional: %s' % rule
+    def skippable(start, end):
+        return all(optional[start:end])
+    rest_categories = {}
+    def rest_category(q):
+        if q not in rest_categories:
+            name = add_category(grammar, '%s_%s' % (rule.lhs, '_'.join(rhs[:q])))
+            rest_categories[q] = name
+            add_rules_from(name, q, False)
+        return rest_categories[q]
+    def add_rules_from(lhs, q, top):
+        # Element q is present.  The next element present is element r.
+        for r in range(q + 1, n):
+            if not skippable(q + 1, r):
+                break
+            if skippable(r + 1, n):
+                add_rule(grammar, Rule(lhs, (rhs[q], rhs[r]),
+                                       optional_semantics(rule, q, r, False, top)))
+            if r < n - 1:
+                add_rule(grammar, Rule(lhs, (rhs[q], rest_category(r)),
+                                       optional_semantics(rule, q, r, True, top)))
+        if top and skippable(q + 1, n):
+            add_rule(grammar, Rule(lhs, (rhs[q],),
+                                   optional_semantics(rule, q, None, False, top)))
+    # The first element present is element q.
+    for q in range(n):
+        if not skippable(0, q):
+            break
+        add_rules_from(rule.lhs, q, True)
+
+def optional_semantics(rule, q, r, rest_is_category, top):
+    """
+    Returns the semantics for one of the rules added by
+    add_rule_with_optional_categories().  Its first child is element q of the
+    RHS.  Its second child, if any, is element r, or, if rest_is_category, the
+    new category covering the RHS from element r onward.  If top, the rule
+    produces the original LHS; otherwise it produces a new category.
+    """
+    n = len(rule.rhs)
+    if top and not isinstance(rule.sem, FunctionType):
+        return rule.sem
+    def sem(sems):
+        args = [None] * q if top else []
+        args.append(sems[0])
+        if r is None:
+            args.extend([None] * (n - 1 - q))
+        else:
+            args.extend([None] * (r - q - 1))
+            if rest_is_category:
+                args.extend(sems[1])
+            else:
+                args.append(sems[1])
+                args.extend([None] * (n - 1 - r))
+        return rule.sem(args) if top else args
+    return sem
+
+def add_category(grammar, base_name):
+    """Adds and returns a new category name, based on the given name."""
+    assert is_cat(base_name)
+    name = base_name
+    while name in grammar.categories:
+        name = name + '_'
+    grammar.categories.add(name)
+    return name
+
 def add_n_ary_rule(grammar, rule):
     """
     Handles adding a rule with three or more non-terminals on the RHS.
@@ -255,84 +555,698 @@ def add_n_ary_rule(grammar, rule):
         Rule('$Z_$A', '$B $C $D')
         Rule('$Z', '$A $Z_$A')
     """
-    def add_category(base_name):
-        assert is_cat(base_name)
-        name = base_name
-        while name in grammar.categories:
-            name = name + '_'
-        grammar.categories.add(name)
-        return name
-    category = add_category('%s_%s' % (rule.lhs, rule.rhs[0]))
+    category = add_category(grammar, '%s_%s' % (rule.lhs, rule.rhs[0]))
     add_rule(grammar, Rule(category, rule.rhs[1:], lambda sems: sems))
     add_rule(grammar, Rule(rule.lhs, (rule.rhs[0], category),
                            lambda sems: apply_semantics(rule, [sems[0]] + sems[1])))
 
-def parse_input(grammar, input):
+class CompiledGrammar:
+    """
+    The rule indexes of a Grammar, keyed by integer symbol ids rather than by
+    strings.  This is the form used by the chart parser:
+
+        lexical  a trie of lexical rules: each node maps a terminal id to
+                 the node for the RHS prefix extended by that terminal, and
+                 maps None to the list of rules whose RHS ends at that node
+        unary    maps a category id to a list of rules
+        binary   maps a left category id to a map from right category id to
+                 a list of rules
+
+    max_lexical_length is the length of the longest lexical RHS.  rules lists
+    every rule in the indexes, and rule_index maps each of them to its position
+    in that list.  unary_components maps each category which lies on a cycle of
+    unary rules to the id of its strongly connected component of the unary
+    category graph, and unary_cycles lists those components.  unary_order lists
+    the categories of the unary category graph in a topological order of its
+    components (see find_unary_cycles()).
+    """
+    def __init__(self, grammar):
+        self.rules = []
+        self.lexical = {}
+        self.max_lexical_length = 0
+        self.unary = {}
+        self.binary = {}
+        for rhs, rules in list(grammar.lexical_rules.items()):
+            if rules:
+                node = self.lexical
+                for rhsi in rhs:
+                    node = node.setdefault(intern_symbol(rhsi), {})
+                node[None] = list(rules)
+                self.max_lexical_length = max(self.max_lexical_length, len(rhs))
+                self.rules.extend(rules)
+        for rhs, rules in list(grammar.unary_rules.items()):
+            if rules:
+                self.unary[intern_symbol(rhs[0])] = list(rules)
+                self.rules.extend(rules)
+        for rhs, rules in list(grammar.binary_rules.items()):
+            if rules:
+                left, right = intern_symbol(rhs[0]), intern_symbol(rhs[1])
+                self.binary.setdefault(left, {})[right] = list(rules)
+                self.rules.extend(rules)
+        self.rule_index = dict((rule, index) for index, rule in enumerate(self.rules))
+        self.start_id = intern_symbol(grammar.start_symbol) if grammar.start_symbol else None
+        self.unary_components, self.unary_cycles, self.unary_order = \
+            find_unary_cycles(self.unary)
+        for cycle in self.unary_cycles:
+            print('Grammar contains unary cycles among: %s' % ', '.join(
+                [symbols[category] for category in cycle]))
+
+def find_unary_cycles(unary):
+    """
+    Finds the strongly connected components of the graph with an edge from each
+    category to the LHS of each unary rule which applies to it.  Returns a
+    triple (components, cycles, order): components maps each category on a
+    cycle to the index of its component in cycles, which lists the categories
+    of each component which contains a cycle, in increasing order of id, and
+    order lists every category in the graph, those of each component together,
+    with each component before any component a unary rule derives from it.
+    This is Tarjan's algorithm, which takes time linear in the number of rules.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    components = {}
+    order = []
+    def visit(category):
+        index[category] = lowlink[category] = len(index)
+        stack.append(category)
+        on_stack.add(category)
+        for rule in unary.get(category, ()):
+            if rule.lhs_id not in index:
+                visit(rule.lhs_id)
+                lowlink[category] = min(lowlink[category], lowlink[rule.lhs_id])
+            elif rule.lhs_id in on_stack:
+                lowlink[category] = min(lowlink[category], index[rule.lhs_id])
+        if lowlink[category] == index[category]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == category:
+                    break
+            # Tarjan's algorithm finds each component after those it derives.
+            order[:0] = sorted(component)
+            if len(component) > 1 or any([rule.lhs_id == category
+                                          for rule in unary.get(category, ())]):
+                for member in component:
+                    components[member] = len(cycles)
+                cycles.append(sorted(component))
+    for category in sorted(unary):
+        if category not in index:
+            visit(category)
+    return components, cycles, order
+
+def find_lexical_matches(compiled, token_ids):
+    """
+    Returns a list of maps, one per chart column: the map for column j takes
+    each i such that lexical rules match span (i, j) to the list of those rules.
+    From each start position we walk down the lexical trie once, so spans which
+    no lexical rule could match are never looked at.
+    """
+    matches = [{} for j in range(len(token_ids) + 1)]
+    for i in range(len(token_ids)):
+        node = compiled.lexical
+        end = min(len(token_ids), i + compiled.max_lexical_length)
+        for j in range(i + 1, end + 1):
+            node = node.get(token_ids[j - 1])
+            if node is None:
+                break
+            rules = node.get(None)
+            if rules:
+                matches[j][i] = rules
+    return matches
+
+class FrozenIndex(dict):
+    """
+    A read-only rule index.  Unlike a defaultdict, looking up a missing key
+    raises KeyError (or, with get(), returns the default) and never inserts it.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('FrozenIndex is read-only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+def freeze_index(index):
+    return FrozenIndex((key, tuple(rules)) for key, rules in list(index.items()) if rules)
+
+def freeze_grammar(grammar):
+    """
+    Compiles the given grammar and replaces its rule indexes with read-only
+    FrozenIndexes, whose values are tuples.  Empty entries (such as those
+    inserted by lookups in the defaultdicts) are dropped.  Once frozen, the
+    grammar rejects new rules, and no amount of parsing can make its indexes
+    grow.  Returns the CompiledGrammar.
+    """
+    compiled = compile_grammar(grammar)
+    grammar.lexical_rules = freeze_index(grammar.lexical_rules)
+    grammar.unary_rules = freeze_index(grammar.unary_rules)
+    grammar.binary_rules = freeze_index(grammar.binary_rules)
+    grammar.categories = frozenset(grammar.categories)
+    grammar.frozen = True
+    return compiled
+
+def compile_grammar(grammar):
+    """
+    Returns the CompiledGrammar for the given grammar, building it if the
+    grammar has not yet been compiled or has had rules added since.
+    """
+    if getattr(grammar, 'compiled', None) is None:
+        grammar.compiled = CompiledGrammar(grammar)
+    return grammar.compiled
+
+class ChartCell(list):
+    """
+    The list of parses for one span of the chart.  Once the cell is complete,
+    index_cell() also groups its parses by category in by_category, a map from
+    category id to the list of parses of that category, in cell order.
+    """
+    by_category = {}
+
+def index_cell(cell):
+    by_category = {}
+    for parse in cell:
+        parses = by_category.get(parse.rule.lhs_id)
+        if parses is None:
+            by_category[parse.rule.lhs_id] = [parse]
+        else:
+            parses.append(parse)
+    cell.by_category = by_category
+
+class SpanCache:
+    """
+    A bounded cache of complete chart cells, keyed by the tuple of tokens each
+    cell spans, which evicts the least recently used cell when full.  Since
+    rules are context-free and annotators look only at the span they annotate,
+    the cell for a span depends only on its tokens, so a cell built for one
+    input can be reused for the same phrase in any other.  Note that the parses
+    in a cached cell are then shared among the inputs, and must not be changed.
+    hits and misses count lookups, to show whether the cache is paying off.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cells = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, span):
+        cell = self.cells.pop(span, None)
+        if cell is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cells[span] = cell  # now the most recently used
+        return cell
+
+    def put(self, span, cell):
+        self.cells[span] = cell
+        if len(self.cells) > self.capacity:
+            self.cells.popitem(last=False)
+
+    def clear(self):
+        self.cells.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return 1.0 * self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return 'SpanCache(%d cells, %d hits, %d misses, hit rate %.3f)' % (
+            len(self.cells), self.hits, self.misses, self.hit_rate())
+
+def make_chart(num_tokens):
+    """
+    Returns an empty chart for an input of the given length.  The chart is a
+    triangular array stored by column: the cell for span (i, j) is chart[j][i],
+    so column j holds the cells for every span ending at token j.
+    """
+    return [[ChartCell() for i in range(j)] for j in range(num_tokens + 1)]
+
+def parse_input(grammar, input, rule_score_fn=None):
     """
     Returns the list of parses for the given input which can be derived using
-    the given grammar.
+    the given grammar.  If the grammar is in beam mode, rule_score_fn gives the
+    score contributed by each use of a rule (by default, zero), and the chart is
+    pruned with these scores as it is built.
     """
-    tokens = input.split()
+    rule_scores = RuleScores(rule_score_fn) if uses_beam(grammar) else None
+    chart = build_chart(grammar, input.split(), rule_scores,
+                        getattr(grammar, 'span_cache', None),
+                        getattr(grammar, 'semantic_dedup', None))
+    # print_chart(chart)
+    return complete_parses(compile_grammar(grammar), chart)
+
+def build_chart(grammar, tokens, rule_scores=None, span_cache=None, semantic_dedup=None):
+    """
+    Returns the complete chart for the given tokens.  Unlike parse_input(),
+    this takes the beam scores, span cache and semantic deduplication mode as
+    arguments, rather than from the grammar.
+    """
+    compiled = compile_grammar(grammar)
+    token_ids = tuple(symbol_ids.get(token, -1) for token in tokens)
+    lexical_matches = find_lexical_matches(compiled, token_ids)
+    annotations = find_annotations(grammar, tokens)
     # TODO: populate chart with tokens?  that way everything is in the chart
-    chart = defaultdict(list)
+    chart = make_chart(len(tokens))
     for j in range(1, len(tokens) + 1):
-        for i in range(j - 1, -1, -1):
-            apply_annotators(grammar, chart, tokens, i, j)
-            apply_lexical_rules(grammar, chart, tokens, i, j)
-            apply_binary_rules(grammar, chart, i, j)
-            apply_unary_rules(grammar, chart, i, j)
-    # print_chart(chart)
-    parses = chart[(0, len(tokens))]
-    if grammar.start_symbol:
-        parses = [parse for parse in parses if parse.rule.lhs == grammar.start_symbol]
-    return parses
+        fill_column(grammar, compiled, chart, tokens, annotations[j], lexical_matches[j],
+                    rule_scores, span_cache, semantic_dedup, j)
+    return chart
 
-def apply_annotators(grammar, chart, tokens, i, j):
-    """Add parses to chart cell (i, j) by applying annotators."""
-    if hasattr(grammar, 'annotators'):
-        for annotator in grammar.annotators:
-            for category, semantics in annotator.annotate(tokens[i:j]):
-                if not check_capacity(chart, i, j):
-                    return
-                rule = Rule(category, tuple(tokens[i:j]), semantics)
-                chart[(i, j)].append(Parse(rule, tokens[i:j]))
-
-def apply_lexical_rules(grammar, chart, tokens, i, j):
-    """Add parses to chart cell (i, j) by applying lexical rules."""
-    for rule in grammar.lexical_rules[tuple(tokens[i:j])]:
-        if not check_capacity(chart, i, j):
+def fill_column(grammar, compiled, chart, tokens, annotations, lexical_matches, rule_scores,
+                span_cache, semantic_dedup, j):
+    """
+    Fills column j of the chart, that is, the cells for every span ending at
+    token j, given the annotations and lexical matches for those spans (each a
+    map from i to the matches for span (i, j)).  The cells of earlier columns
+    must already be complete, and are not changed.
+    """
+    # In beam mode, the contents of a cell depend on the scores, so cached
+    # cells cannot be used.
+    if rule_scores is not None:
+        span_cache = None
+    for i in range(j - 1, -1, -1):
+        if span_cache is not None:
+            span = tuple(tokens[i:j])
+            cell = span_cache.get(span)
+            if cell is not None:
+                chart[j][i] = cell
+                continue
+        apply_annotators(chart, tokens, annotations.get(i, ()), i, j)
+        apply_lexical_rules(chart, tokens, lexical_matches.get(i, ()), i, j)
+        if rule_scores is None:
+            apply_binary_rules(compiled, chart, i, j)
+        else:
+            apply_binary_rules_to_beam(grammar, compiled, chart, rule_scores, i, j)
+        if rule_scores is not None:
+            prune_cell(grammar, chart[j][i], rule_scores)
+        if semantic_dedup:
+            dedup_cell(chart[j][i], semantic_dedup == 'pack')
+        apply_unary_rules(compiled, chart, i, j)
+        # A unary parse scores the same as its child under a rule's zero weight,
+        # and would lose the tie to it, so parses are not pruned across
+        # categories once the unary rules have been applied.
+        if rule_scores is not None:
+            prune_cell(grammar, chart[j][i], rule_scores, category_only=True)
+        if semantic_dedup:
+            dedup_cell(chart[j][i], semantic_dedup == 'pack')
+        if chart[j][i]:
+            index_cell(chart[j][i])
+        if span_cache is not None:
+            span_cache.put(span, chart[j][i])
+
+def complete_parses(compiled, chart):
+    """
+    Returns the parses in the chart which span the whole input and (if the
+    grammar has a start symbol) belong to the start symbol.
+    """
+    if len(chart) <= 1:
+        return []
+    top_cell = chart[-1][0]
+    if compiled.start_id is not None:
+        return list(top_cell.by_category.get(compiled.start_id, []))
+    return list(top_cell)
+
+class IncrementalParser:
+    """
+    Parses an input one token at a time.  Since the chart is filled column by
+    column, and the cells of a column depend only on the tokens up to that
+    column, each new token costs only the filling of one new column.  After a
+    correction, only the columns from the first changed token on are refilled:
+
+        parser = IncrementalParser(grammar)
+        parser.add_token('flights')
+        parser.add_token('to')
+        parser.parses()                     # the parses of 'flights to'
+        parser.parse('flights from boston') # refills columns 2 and 3 only
+    """
+    def __init__(self, grammar, rule_score_fn=None):
+        self.grammar = grammar
+        self.compiled = compile_grammar(grammar)
+        self.rule_scores = RuleScores(rule_score_fn) if uses_beam(grammar) else None
+        self.tokens = []
+        self.chart = make_chart(0)
+        # The lexical trie nodes still live after each column (see
+        # advance_lexical_matches()).
+        self.lexical_nodes = [[]]
+
+    def add_token(self, token):
+        """Extends the input by the given token, and fills the new column."""
+        self.tokens.append(token)
+        j = len(self.tokens)
+        lexical_matches, lexical_nodes = advance_lexical_matches(
+            self.compiled, self.lexical_nodes[-1], symbol_ids.get(token, -1), j)
+        self.lexical_nodes.append(lexical_nodes)
+        self.chart.append([ChartCell() for i in range(j)])
+        fill_column(self.grammar, self.compiled, self.chart, self.tokens,
+                    annotate_column(self.grammar, self.tokens, j), lexical_matches,
+                    self.rule_scores, getattr(self.grammar, 'span_cache', None),
+                    getattr(self.grammar, 'semantic_dedup', None), j)
+
+    def truncate(self, num_tokens):
+        """Discards all but the first num_tokens tokens, and their columns."""
+        del self.tokens[num_tokens:]
+        del self.chart[num_tokens + 1:]
+        del self.lexical_nodes[num_tokens + 1:]
+
+    def parse(self, input):
+        """
+        Returns the list of parses for the given input, reusing the columns for
+        the longest prefix it shares with the current input.
+        """
+        tokens = input.split()
+        common = 0
+        while (common < min(len(tokens), len(self.tokens)) and
+               tokens[common] == self.tokens[common]):
+            common += 1
+        self.truncate(common)
+        for token in tokens[common:]:
+            self.add_token(token)
+        return self.parses()
+
+    def parses(self):
+        """
+        Returns the list of parses for the current input, post-processed by
+        the grammar's finish_parses(), as Grammar.parse_input() does.
+        """
+        return self.grammar.finish_parses(' '.join(self.tokens),
+                                          complete_parses(self.compiled, self.chart))
+
+def advance_lexical_matches(compiled, nodes, token_id, j):
+    """
+    Advances the lexical trie by token j, for use by an IncrementalParser.
+    nodes is a list of pairs (i, node), where node is the trie node reached by
+    tokens i through j - 1, for each i for which there is one.  Returns a pair:
+    a map from i to the lexical rules matching span (i, j), and the list of
+    pairs (i, node) for the nodes reached by tokens i through j.
+    """
+    matches = {}
+    advanced = []
+    for i, node in nodes + [(j - 1, compiled.lexical)]:
+        node = node.get(token_id)
+        if node is not None:
+            rules = node.get(None)
+            if rules:
+                matches[i] = rules
+            advanced.append((i, node))
+    return matches, advanced
+
+def find_annotations(grammar, tokens):
+    """
+    Returns a list of maps, one per chart column: the map for column j takes
+    each i such that some annotator annotates span (i, j) to the list of pairs
+    (category, semantics) for that span, in the order of grammar.annotators.
+    Each annotator is run once over the whole input (see
+    Annotator.annotate_sentence()).
+    """
+    annotations = [{} for j in range(len(tokens) + 1)]
+    for annotator in getattr(grammar, 'annotators', []):
+        for i, j, category, semantics in annotator.annotate_sentence(tokens):
+            annotations[j].setdefault(i, []).append((category, semantics))
+    return annotations
+
+def annotate_column(grammar, tokens, j):
+    """
+    Like find_annotations(), but for the spans ending at token j only, which is
+    what an IncrementalParser needs.  An annotator which overrides
+    annotate_sentence() has it called on the tokens up to token j (only the
+    last max_tokens of them, if the annotator sets max_tokens), keeping the
+    annotations of spans ending at j; any other has annotate() called on just
+    those spans.
+    """
+    annotations = {}
+    for annotator in getattr(grammar, 'annotators', []):
+        start = 0 if annotator.max_tokens is None else max(j - annotator.max_tokens, 0)
+        if overrides_annotate_sentence(annotator):
+            for i, end, category, semantics in annotator.annotate_sentence(tokens[start:j]):
+                if start + end == j:
+                    annotations.setdefault(start + i, []).append((category, semantics))
+        else:
+            for i in range(j - 1, start - 1, -1):
+                for category, semantics in annotator.annotate(tokens[i:j]):
+                    annotations.setdefault(i, []).append((category, semantics))
+    return annotations
+
+def overrides_annotate_sentence(annotator):
+    """Whether the annotator's class overrides Annotator.annotate_sentence()."""
+    method = annotator.__class__.annotate_sentence
+    return getattr(method, '__func__', method) is not \
+        getattr(Annotator.annotate_sentence, '__func__', Annotator.annotate_sentence)
+
+def apply_annotators(chart, tokens, annotations, i, j):
+    """
+    Add parses to chart cell (i, j) for the given annotations of the span (see
+    find_annotations()).
+    """
+    cell = chart[j][i]
+    for category, semantics in annotations:
+        if not check_capacity(cell):
             return
-        chart[(i, j)].append(Parse(rule, tokens[i:j]))
+        rule = Rule(category, tuple(tokens[i:j]), semantics)
+        cell.append(Parse(rule, tokens[i:j]))
 
-def apply_binary_rules(grammar, chart, i, j):
+def apply_lexical_rules(chart, tokens, rules, i, j):
+    """
+    Add parses to chart cell (i, j) by applying the given lexical rules, which
+    are those matching the span (see find_lexical_matches()).
+    """
+    cell = chart[j][i]
+    for rule in rules:
+        if not check_capacity(cell):
+            return
+        cell.append(Parse(rule, tokens[i:j]))
+
+def apply_binary_rules(compiled, chart, i, j):
     """Add parses to chart cell (i, j) by applying binary rules."""
+    cell = chart[j][i]
+    for rules, left_parses, right_parses in binary_combinations(compiled, chart, i, j):
+        for parse_1 in left_parses:
+            for parse_2 in right_parses:
+                for rule in rules:
+                    if not check_capacity(cell):
+                        return
+                    cell.append(Parse(rule, [parse_1, parse_2]))
+
+def binary_combinations(compiled, chart, i, j):
+    """
+    Generates the triples (rules, left parses, right parses) such that each of
+    the rules combines each of the left parses with each of the right parses
+    into a parse for chart cell (i, j).
+    """
+    # Rather than trying every pair of parses from the two subspans, we work
+    # category by category: for each left category present, we consider only
+    # the right categories which some binary rule pairs with it, so that the
+    # work done is proportional to the number of rules which actually apply.
+    column = chart[j]
+    binary = compiled.binary
     for k in range(i + 1, j):
-        for parse_1, parse_2 in product(chart[(i, k)], chart[(k, j)]):
-            for rule in grammar.binary_rules[(parse_1.rule.lhs, parse_2.rule.lhs)]:
-                if not check_capacity(chart, i, j):
-                    return
-                chart[(i, j)].append(Parse(rule, [parse_1, parse_2]))
+        right_cell = column[k]
+        left_cell = chart[k][i]
+        if not right_cell or not left_cell:
+            continue
+        right_index = right_cell.by_category
+        for left_id, left_parses in left_cell.by_category.items():
+            rules_by_right = binary.get(left_id)
+            if not rules_by_right:
+                continue
+            if len(rules_by_right) > len(right_index):
+                candidates = right_index
+                other = rules_by_right
+            else:
+                candidates = rules_by_right
+                other = right_index
+            for right_id in candidates:
+                if right_id not in other:
+                    continue
+                yield rules_by_right[right_id], left_parses, right_index[right_id]
 
-def apply_unary_rules(grammar, chart, i, j):
+def apply_binary_rules_to_beam(grammar, compiled, chart, rule_scores, i, j):
+    """
+    Like apply_binary_rules(), but for beam mode: rather than stopping at
+    MAX_CELL_CAPACITY, keeps only the parses which prune_cell() could keep, in
+    bounded heaps ordered by inside score (one per category, if the grammar has
+    a category_beam_width).  A combination which cannot make the beam is never
+    made into a Parse.  Ties are resolved in favor of parses made earlier, as in
+    prune_cell().
+    """
+    cell = chart[j][i]
+    beam_width = getattr(grammar, 'beam_width', None)
+    category_beam_width = getattr(grammar, 'category_beam_width', None)
+    if category_beam_width is None:
+        capacity = beam_width
+    else:
+        capacity = min(category_beam_width, beam_width or category_beam_width)
+    # Each heap holds triples (inside score, -sequence number, parse), so that
+    # its first element is the worst parse, and the latest among equals.
+    heaps = {}
+    def heap_for(score, sequence, category_id):
+        # The heap in which a parse with the given score belongs, or None if it
+        # could not make the beam.
+        heap = heaps.setdefault(category_id if category_beam_width else None, [])
+        if len(heap) >= capacity and (score, -sequence) < heap[0][:2]:
+            return None
+        return heap
+    def keep(heap, score, sequence, parse):
+        parse.inside_score = score
+        if len(heap) < capacity:
+            heapq.heappush(heap, (score, -sequence, parse))
+        else:
+            heapq.heappushpop(heap, (score, -sequence, parse))
+    score_parses(cell, rule_scores)
+    sequence = 0
+    for parse in cell:
+        heap = heap_for(parse.inside_score, sequence, parse.rule.lhs_id)
+        if heap is not None:
+            keep(heap, parse.inside_score, sequence, parse)
+        sequence += 1
+    for rules, left_parses, right_parses in binary_combinations(compiled, chart, i, j):
+        for parse_1 in left_parses:
+            for parse_2 in right_parses:
+                for rule in rules:
+                    # Summed in the same order as by score_parses().
+                    score = rule_scores[rule] + parse_1.inside_score + parse_2.inside_score
+                    heap = heap_for(score, sequence, rule.lhs_id)
+                    if heap is not None:
+                        keep(heap, score, sequence, Parse(rule, [parse_1, parse_2]))
+                    sequence += 1
+    kept = [entry for heap in heaps.values() for entry in heap]
+    cell[:] = [parse for score, negative_sequence, parse in
+               sorted(kept, key=lambda entry: -entry[1])]
+
+def apply_unary_rules(compiled, chart, i, j):
     """Add parses to chart cell (i, j) by applying unary rules."""
-    # Note that the last line of this method can add new parses to chart[(i,
-    # j)], the list over which we are iterating.  Because of this, we
-    # essentially get unary closure "for free".  (However, if the grammar
-    # contains unary cycles, we'll get stuck in a loop, which is one reason for
-    # check_capacity().)
-    for parse in chart[(i, j)]:
-        for rule in grammar.unary_rules[(parse.rule.lhs,)]:
-            if not check_capacity(chart, i, j):
+    # We make a single pass over an agenda of parses, which grows as we iterate
+    # over it, so the new parses are added to the cell in breadth-first order.
+    # Every chain of unary rules is applied, except that a chain stops short of
+    # any rule which would produce a category already produced along it.  Such
+    # a category can only lie in the same component of unary cycles as the
+    # parse's own category (see find_unary_cycles()), so each agenda item pairs
+    # a parse with the categories produced along its chain within its
+    # component, or with None if its category lies on no cycle.
+    cell = chart[j][i]
+    unary = compiled.unary
+    components = compiled.unary_components
+    agenda = [(parse, None) for parse in cell]
+    for parse, path in agenda:
+        category_id = parse.rule.lhs_id
+        component = components.get(category_id)
+        if component is not None and path is None:
+            path = (category_id,)
+        for rule in unary.get(category_id, ()):
+            if path is not None and rule.lhs_id in path:
+                continue
+            if not check_capacity(cell):
                 return
-            chart[(i, j)].append(Parse(rule, [parse]))
+            unary_parse = Parse(rule, [parse])
+            cell.append(unary_parse)
+            if components.get(rule.lhs_id) is None:
+                agenda.append((unary_parse, None))
+            elif components[rule.lhs_id] == component:
+                agenda.append((unary_parse, path + (rule.lhs_id,)))
+            else:
+                agenda.append((unary_parse, (rule.lhs_id,)))
+
+class RuleScores(dict):
+    """
+    Memoizes rule_score_fn over the rules used in one call to parse_input(),
+    since computing the score of a rule may be relatively costly.
+    """
+    def __init__(self, rule_score_fn):
+        self.rule_score_fn = rule_score_fn or (lambda rule: 0.0)
+
+    def __missing__(self, rule):
+        score = self.rule_score_fn(rule)
+        self[rule] = score
+        return score
+
+def score_parses(cell, rule_scores):
+    """
+    Sets inside_score for each parse in the cell which lacks one.  The inside
+    score of a parse is the score of its rule plus the inside scores of its
+    children, so for a linear model over rule features it equals the model score
+    of the parse, and the scores of children are computed once and reused.
+    Since every parse appears in the cell after its children, a single pass in
+    order suffices.
+    """
+    for parse in cell:
+        if not hasattr(parse, 'inside_score'):
+            score = rule_scores[parse.rule]
+            for child in parse.children:
+                if isinstance(child, Parse):
+                    score += child.inside_score
+            parse.inside_score = score
+
+def prune_cell(grammar, cell, rule_scores, category_only=False):
+    """
+    Scores the parses in the cell and keeps only the best of them, subject to
+    the beam widths of the grammar, or only to category_beam_width if
+    category_only is true.  Ties are resolved in favor of parses which were
+    added to the cell earlier.
+    """
+    score_parses(cell, rule_scores)
+    ranked = sorted(cell, key=lambda parse: parse.inside_score, reverse=True)
+    category_beam_width = getattr(grammar, 'category_beam_width', None)
+    if category_beam_width is not None:
+        counts = defaultdict(int)
+        kept = []
+        for parse in ranked:
+            if counts[parse.rule.lhs_id] < category_beam_width:
+                counts[parse.rule.lhs_id] += 1
+                kept.append(parse)
+        ranked = kept
+    beam_width = getattr(grammar, 'beam_width', None)
+    if beam_width is not None and not category_only:
+        ranked = ranked[:beam_width]
+    cell[:] = ranked
+
+def semantics_key(sem):
+    """
+    Returns a key for the given semantic value, for use in a dict.  Semantics
+    which are hashable (such as tuples of strings) serve as their own keys,
+    which is much cheaper than computing their fingerprints.
+    """
+    try:
+        hash(sem)
+        return (type(sem), sem)
+    except TypeError:
+        return semantics_fingerprint(sem)
+
+def dedup_cell(cell, pack):
+    """
+    Merges the parses in the cell which have the same category and semantics,
+    keeping only the first of each group.  In beam mode, prune_cell() has just
+    sorted the cell, so this is the best-scoring parse of the group; otherwise
+    it is the one built first.  If pack is true, the other parses of the group
+    are added to the alternatives of the one kept, so that no derivation is
+    lost; otherwise they are dropped.  Either way, the set of distinct meanings
+    in the cell is unchanged, but larger spans are built from fewer parses.
+    This computes the semantics of every parse in the cell.
+    """
+    kept = {}
+    deduped = []
+    for parse in cell:
+        key = (parse.rule.lhs_id, semantics_key(parse.semantics))
+        representative = kept.get(key)
+        if representative is None:
+            kept[key] = parse
+            deduped.append(parse)
+        elif pack and representative is not parse:
+            try:
+                representative.alternatives.append(parse)
+            except AttributeError:
+                representative.alternatives = [parse]
+    if len(deduped) < len(cell):
+        cell[:] = deduped
 
 # Important for catching e.g. unary cycles.
 max_cell_capacity_hits = 0
-def check_capacity(chart, i, j):
+def check_capacity(cell):
     global max_cell_capacity_hits
-    if len(chart[(i, j)]) >= MAX_CELL_CAPACITY:
-        # print 'Cell (%d, %d) has reached capacity %d' % (
-        #     i, j, MAX_CELL_CAPACITY)
+    if len(cell) >= MAX_CELL_CAPACITY:
+        # print 'Cell has reached capacity %d' % MAX_CELL_CAPACITY
         max_cell_capacity_hits += 1
         lg_max_cell_capacity_hits = math.log(max_cell_capacity_hits, 2)
         if int(lg_max_cell_capacity_hits) == lg_max_cell_capacity_hits:
@@ -341,6 +1255,166 @@ def check_capacity(chart, i, j):
         return False
     return True
 
+
+# Batch parsing ================================================================
+
+# The function being mapped by fork_map().  Worker processes inherit it when
+# they are forked, so it need not be picklable.
+fork_map_fn = None
+
+def call_fork_map_fn(input):
+    return fork_map_fn(input)
+
+def fork_map(fn, inputs, processes=None):
+    """
+    Returns [fn(input) for input in inputs], computed by a pool of worker
+    processes (by default, one per core).  The workers are forked, so they share
+    the grammar, annotators and executor already built by this process, even
+    though rule semantics are functions which cannot be pickled.  The inputs and
+    results must be picklable.  Any side effects of fn (such as additions to an
+    annotator's cache) are lost when the workers exit.
+    """
+    global fork_map_fn
+    inputs = list(inputs)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(inputs))
+    if processes <= 1:
+        return [fn(input) for input in inputs]
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing  # Python 2 always forks
+    fork_map_fn = fn
+    try:
+        pool = context.Pool(processes)
+        try:
+            return pool.map(call_fork_map_fn, inputs)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        fork_map_fn = None
+
+class ForkWorkers(object):
+    """
+    A fixed set of forked worker processes, each of which applies fn to every
+    input sent to it.  Unlike fork_map(), which forks a new pool for each call,
+    the workers live until close() is called, so any state fn keeps in a worker
+    (such as a cache) persists from one call of map() to the next.  As with
+    fork_map(), fn need not be picklable, but the inputs and results must be.
+    If processes is 1 (or less), fn is applied in this process instead.
+    """
+    def __init__(self, fn, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.fn = fn
+        self.processes = max(processes, 1)
+        self.connections = []
+        self.workers = []
+        if self.processes == 1:
+            return
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing  # Python 2 always forks
+        for _ in range(self.processes):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=run_fork_worker, args=(fn, worker_connection))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def map(self, inputs):
+        """
+        Returns [fn(input) for input in inputs], where inputs holds one input
+        for each worker, and input i is sent to worker i.
+        """
+        assert len(inputs) == self.processes, len(inputs)
+        if not self.workers:
+            return [self.fn(input) for input in inputs]
+        for connection, input in zip(self.connections, inputs):
+            connection.send(input)
+        # Every reply is received before any failure is raised, so that none is
+        # left to be mistaken for the reply to a later call.
+        replies = [connection.recv() for connection in self.connections]
+        for ok, result in replies:
+            if not ok:
+                raise RuntimeError('Worker process failed:\n%s' % result)
+        return [result for ok, result in replies]
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+def run_fork_worker(fn, connection):
+    """The loop run by each process of a ForkWorkers, until it is sent None."""
+    while True:
+        input = connection.recv()
+        if input is None:
+            break
+        try:
+            connection.send((True, fn(input)))
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+    connection.close()
+
+def encode_parses(compiled, parses):
+    """
+    Returns a picklable encoding of the given list of parses, to be decoded by
+    decode_parses().  Each rule of the grammar is encoded by its index in
+    compiled.rules; other rules (those created by annotators, whose semantics
+    are plain values) are encoded as (lhs, rhs, sem).  Subparses shared among
+    the parses are encoded only once.  The score and denotation of each parse
+    are kept, and so are its semantics, if they have been computed.
+    """
+    nodes = []
+    node_ids = {}
+    def encode(parse):
+        if id(parse) not in node_ids:
+            children = tuple([encode(child) if isinstance(child, Parse) else child
+                              for child in parse.children])
+            rule_code = compiled.rule_index.get(parse.rule)
+            if rule_code is None:
+                rule_code = (parse.rule.lhs, parse.rule.rhs, parse.rule.sem)
+            node_ids[id(parse)] = len(nodes)
+            nodes.append((rule_code, children))
+        return node_ids[id(parse)]
+    tops = []
+    for parse in parses:
+        try:
+            # Unlike plain attribute access, this does not compute semantics.
+            semantics = (object.__getattribute__(parse, 'semantics'),)
+        except AttributeError:
+            semantics = ()
+        tops.append((encode(parse), parse.score, parse.denotation, semantics))
+    return nodes, tops
+
+def decode_parses(compiled, encoding):
+    """Returns the list of parses encoded by encode_parses()."""
+    nodes, tops = encoding
+    decoded = []
+    for rule_code, children in nodes:
+        rule = compiled.rules[rule_code] if isinstance(rule_code, int) else Rule(*rule_code)
+        decoded.append(Parse(rule, [decoded[child] if isinstance(child, int) else child
+                                    for child in children]))
+    parses = []
+    for node, score, denotation, semantics in tops:
+        parse = decoded[node]
+        parse.score = score
+        parse.denotation = denotation
+        if semantics:
+            parse.semantics = semantics[0]
+        parses.append(parse)
+    return parses
+
 def print_grammar(grammar):
     def all_rules(rule_index):
         return [rule for rules in list(rule_index.values()) for rule in rules]
@@ -356,11 +1430,13 @@ def print_grammar(grammar):
 
 def print_chart(chart):
     """Print the chart.  Useful for debugging."""
-    spans = sorted(list(chart.keys()), key=(lambda span: span[0]))
+    spans = [(i, j) for j in range(len(chart)) for i in range(j)]
+    spans = sorted(spans, key=(lambda span: span[0]))
     spans = sorted(spans, key=(lambda span: span[1] - span[0]))
-    for span in spans:
-        if len(chart[span]) > 0:
-            print('%-12s' % str(span), end=' ')
-            print(chart[span][0])
-            for entry in chart[span][1:]:
+    for i, j in spans:
+        cell = chart[j][i]
+        if len(cell) > 0:
+            print('%-12s' % str((i, j)), end=' ')
+            print(cell[0])
+            for entry in cell[1:]:
                 print('%-12s' % ' ', entry)
@@ -8,46 +8,270 @@ __email__ = "See the author's website"
 
 from collections import defaultdict
 
-from parsing import Parse
+import numpy as np
+
+from forest import kbest_parses, parse_forest
+from parsing import (Parse, compile_grammar, decode_parses, encode_parses, fork_map,
+                     uses_beam)
 
 # TODO: annotations are generating rule features -- they shouldn't.
 def rule_features(parse):
     """
     Returns a map from (string representations of) rules to how often they were
-    used in the given parse.
+    used in the given parse.  Each rule's feature (see rule_feature()) is looked
+    up once per call.
     """
-    def collect_rule_features(parse, features):
-        feature = str(parse.rule)
-        features[feature] += 1.0
-        for child in parse.children:
-            if isinstance(child, Parse):
-                collect_rule_features(child, features)
     features = defaultdict(float)
-    collect_rule_features(parse, features)
+    for rule, count in rule_counts(parse).items():
+        features[rule_feature(rule)] += count
     return features
 
+def rule_counts(parse):
+    """Returns a map from each Rule used in the given parse to how often it is used."""
+    counts = {}
+    stack = [parse]
+    while stack:
+        parse = stack.pop()
+        counts[parse.rule] = counts.get(parse.rule, 0.0) + 1.0
+        for child in reversed(parse.children):
+            if isinstance(child, Parse):
+                stack.append(child)
+    return counts
+
+def rule_feature(rule):
+    """
+    Returns the feature for uses of the given rule, which is its string
+    representation.  It is computed once per Rule and remembered.
+    """
+    try:
+        return rule.feature
+    except AttributeError:
+        rule.feature = str(rule)
+        return rule.feature
+
 def score(parse=None, feature_fn=None, weights=None):
     """Returns the inner product of feature_fn(parse) and weights."""
     assert parse and feature_fn and weights != None
     return sum(weights[feature] * value for feature, value in list(feature_fn(parse).items()))
 
-class Model:
+def rule_score(rule, weights):
+    """
+    Returns the contribution of a single use of the given rule to the score of a
+    parse under rule_features.  Unlike weights[feature], this never inserts into
+    weights.
+    """
+    return weights.get(rule_feature(rule), 0.0)
+
+
+# Feature indexes and weight vectors ===========================================
+
+class FeatureIndex:
+    """
+    Assigns consecutive integer ids to feature keys (such as the strings
+    produced by rule_features), in order of first appearance.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """Returns the id of the given key, assigning a new one if necessary."""
+        feature_id = self.ids.get(key)
+        if feature_id is None:
+            feature_id = len(self.keys)
+            self.ids[key] = feature_id
+            self.keys.append(key)
+        return feature_id
+
+class WeightVector(object):
+    """
+    Feature weights, stored in a dense NumPy array indexed by a FeatureIndex,
+    but usable wherever a map from feature keys to weights is expected.  As
+    with a defaultdict(float), the weight of an unknown feature is zero; unlike
+    one, looking it up does not add it.  Setting a weight adds the feature to
+    the index if need be.
+    """
+    def __init__(self, index, weights={}):
+        self.index = index
+        self.array = np.zeros(max(len(index), 16))
+        for key, value in list(weights.items()):
+            self[key] = value
+
+    def __getitem__(self, key):
+        feature_id = self.index.ids.get(key)
+        if feature_id is None or feature_id >= len(self.array):
+            return 0.0
+        return float(self.array[feature_id])
+
+    def __setitem__(self, key, value):
+        feature_id = self.index.add(key)
+        self.array = self.dense(feature_id + 1)
+        self.array[feature_id] = value
+
+    def get(self, key, default=0.0):
+        if key in self.index.ids:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self.index.ids
+
+    def __iter__(self):
+        return iter(self.index.keys)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys)
+
+    def items(self):
+        return [(key, self[key]) for key in self.index.keys]
+
+    def dense(self, size):
+        """
+        Returns the weight array, extended with zeros if need be so that it has
+        at least the given length.  It grows by doubling, so that adding
+        features one by one takes amortized constant time.
+        """
+        if size > len(self.array):
+            array = np.zeros(max(size, 2 * len(self.array)))
+            array[:len(self.array)] = self.array
+            return array
+        return self.array
+
+class FeatureMatrix:
+    """
+    The feature vectors of a list of candidate parses, as a sparse matrix in
+    compressed sparse row form: the features of row i are the ids
+    indices[indptr[i]:indptr[i + 1]], with values in the same slice of data.
+    Features not in the index are added to it if add is true, and otherwise
+    dropped, since their weight is zero.
+    """
+    def __init__(self, feature_maps, index, add=False):
+        indices = []
+        data = []
+        indptr = [0]
+        for features in feature_maps:
+            for key, value in list(features.items()):
+                feature_id = index.add(key) if add else index.ids.get(key)
+                if feature_id is not None:
+                    indices.append(feature_id)
+                    data.append(value)
+            indptr.append(len(indices))
+        self.indices = np.array(indices, dtype=int)
+        self.data = np.array(data, dtype=float)
+        self.indptr = np.array(indptr, dtype=int)
+        self.rows = np.repeat(np.arange(len(feature_maps)), np.diff(self.indptr))
+
+    def dot(self, weights):
+        """Returns the array of scores of the rows under the given WeightVector."""
+        num_rows = len(self.indptr) - 1
+        if not len(self.indices):
+            return np.zeros(num_rows)
+        array = weights.dense(int(self.indices.max()) + 1)
+        return np.bincount(self.rows, weights=self.data * array[self.indices],
+                           minlength=num_rows)
+
+
+# Model ========================================================================
+
+class Model(object):
+    """
+    A grammar, executor, feature function and weights.  If rerank_k is given,
+    parses are scored in two passes (see score_parses()), the first using
+    coarse_feature_fn, which must not depend on denotations.  If
+    coarse_feature_fn is None, feature_fn is used for both passes.
+    """
     def __init__(self,
                  grammar=None,
                  feature_fn=lambda parse: defaultdict(float),
                  weights=defaultdict(float),
-                 executor=None):
+                 executor=None,
+                 coarse_feature_fn=None,
+                 rerank_k=None):
         assert grammar
         self.grammar = grammar
         self.feature_fn = feature_fn
+        self.feature_index = FeatureIndex()
         self.weights = weights
         self.executor = executor
+        self.coarse_feature_fn = coarse_feature_fn
+        self.rerank_k = rerank_k
+
+    def get_weights(self):
+        return self._weights
+
+    def set_weights(self, weights):
+        # Whatever map of weights is assigned, it is stored as a WeightVector
+        # over this model's feature index.
+        self._weights = WeightVector(self.feature_index, weights)
+
+    weights = property(get_weights, set_weights)
 
     # TODO: Should this become a static function, to match style of parsing.py?
-    def parse_input(self, input):
-        parses = self.grammar.parse_input(input)
+    def parse_input(self, input, k=None):
+        """
+        Returns the parses of the given input, scored and sorted by decreasing
+        score.  If k is given, the parses are not all enumerated.  Instead, the
+        k best parses under the rule features of the current weights are
+        extracted from a packed forest, and only those are executed and scored.
+        This is exact if feature_fn is rule_features, and otherwise amounts to
+        pruning with the rule features before scoring with feature_fn.  The
+        k best parses are post-processed by the grammar's finish_parses(), as
+        parse_input() does.  The forest is built without the grammar's span
+        cache, and k cannot be used with beam mode or semantic deduplication,
+        which would change the set of parses the k best are drawn from.
+        """
+        if k is None and uses_beam(self.grammar):
+            # Prune the chart with the rule features of the current weights.
+            parses = self.grammar.parse_input(
+                input, rule_score_fn=lambda rule: rule_score(rule, self.weights))
+        elif k is None:
+            parses = self.grammar.parse_input(input)
+        else:
+            assert not uses_beam(self.grammar), 'k-best parsing does not support beam mode'
+            assert not getattr(self.grammar, 'semantic_dedup', None), \
+                'k-best parsing does not support semantic_dedup'
+            forest = parse_forest(self.grammar, input)
+            parses = self.grammar.finish_parses(
+                input, kbest_parses(forest, k, lambda rule: rule_score(rule, self.weights)))
+        return self.score_parses(parses)
+
+    def score_parses(self, parses):
+        """
+        Executes and scores the given parses of one input, and returns them
+        sorted by decreasing score.  If rerank_k is set, the parses are first
+        ranked by their coarse features, before any are executed, and only the
+        best rerank_k of them are executed, scored and returned.
+        """
+        if self.rerank_k is not None:
+            coarse_feature_fn = self.coarse_feature_fn or self.feature_fn
+            features = FeatureMatrix([coarse_feature_fn(parse) for parse in parses],
+                                     self.feature_index)
+            coarse_scores = features.dot(self.weights)
+            # A stable sort on the indexes, so that ties keep parser order.
+            ranked = sorted(range(len(parses)), key=lambda i: coarse_scores[i], reverse=True)
+            parses = [parses[i] for i in ranked[:self.rerank_k]]
         for parse in parses:
             if self.executor:
                 parse.denotation = self.executor(parse.semantics)
-            parse.score = score(parse, self.feature_fn, self.weights)
+        features = FeatureMatrix([self.feature_fn(parse) for parse in parses], self.feature_index)
+        for parse, parse_score in zip(parses, features.dot(self.weights)):
+            parse.score = float(parse_score)
         return sorted(parses, key=lambda parse: parse.score, reverse=True)
+
+    def parse_batch(self, inputs, k=None, processes=None):
+        """
+        Returns a list holding the scored and sorted parses of each of the given
+        inputs, in order, as returned by parse_input().  The inputs are parsed,
+        executed and scored in parallel (see parsing.fork_map()).
+        """
+        compiled = compile_grammar(self.grammar)
+        def parse_one(input):
+            return encode_parses(compiled, self.parse_input(input, k=k))
+        return [decode_parses(compiled, encoding)
+                for encoding in fork_map(parse_one, inputs, processes)]
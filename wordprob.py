@@ -14,7 +14,7 @@ from domain import Domain
 from example import Example
 from experiment import evaluate_for_domain, evaluate_dev_examples_for_domain, train_test, train_test_for_domain, interact, learn_lexical_semantics, generate
 from metrics import DenotationAccuracyMetric
-from parsing import Grammar, print_grammar, compute_semantics
+from parsing import Grammar, Parse, print_grammar, compute_semantics, semantics_fingerprint
 from scoring import rule_features
 
 from nltk.tree import Tree
@@ -198,19 +198,25 @@ class WordProbDomain(Domain):
 
     def grammar(self):
         class WordProbGrammar(Grammar):
-            def parse_input(self, input):
-                parses = Grammar.parse_input(self, input)
+            def finish_parses(self, input, parses):
                 consecutive, even, count = find_number_variables(input)
 
+                finished = []
                 for parse in parses:
                     if isinstance(parse.semantics, tuple):
-                        parse.semantics = [parse.semantics]
-                    parse.semantics.insert(0, ('numvars', count))
+                        semantics = [parse.semantics]
+                    else:
+                        semantics = list(parse.semantics)
+                    semantics.insert(0, ('numvars', count))
                     if consecutive:
-                        parse.semantics.insert(0, ('consecutive', True))
+                        semantics.insert(0, ('consecutive', True))
                     if even == True or even == False:
-                        parse.semantics.insert(0, ('even', even))
-                return parses
+                        semantics.insert(0, ('even', even))
+                    # A copy, since the parse may still be held by the chart.
+                    parse = Parse(parse.rule, parse.children)
+                    parse.semantics = semantics
+                    finished.append(parse)
+                return finished
         return WordProbGrammar(rules=self.rules(), start_symbol='$E')
 
     def training_metric(self):
@@ -313,7 +319,7 @@ def check_parses():
                 empty_answer = True
                 right_answer_check = False
                 gathered_answers = []
-                for _, v in {str(s): s for s in [p.semantics for p in parses]}.iteritems():
+                for _, v in {semantics_fingerprint(s): s for s in [p.semantics for p in parses]}.iteritems():
                     try:
                         answer = domain.execute(v)
                         # don't include empty answers in our list of gathered_answers